@@ -1,3 +1,143 @@
 import os
+import json
 
 basedir = os.path.abspath(os.path.dirname(__file__))
+
+# Maps to load when the app starts (a comma-separated list of names from
+# mapdata.handlers, or "all"). Other maps are loaded on first use.
+preload_maps = [
+    name for name in os.environ.get('MAP3D_PRELOAD_MAPS', '').split(',')
+    if name]
+
+# Directory in which arrays derived from the map files (e.g., the images used
+# to generate postage stamps) are cached.
+cache_path = os.environ.get('MAP3D_CACHE_PATH', os.path.join(basedir, 'cache'))
+
+# If true, the Bayestar maps are stored in the cache directory on first load,
+# and then memory-mapped (read-only), so that all worker processes on a host
+# share one physical copy of the map data.
+share_maps = (os.environ.get('MAP3D_SHARE_MAPS', '0') == '1')
+
+# How often (in seconds) each worker checks whether the files of the maps it
+# has loaded have changed, in which case it reloads them in the background.
+# Set to 0 to disable.
+reload_check_interval = float(os.environ.get('MAP3D_RELOAD_CHECK_INTERVAL', 60.))
+
+# /api/v2 queries of at least this many coordinates are processed and sent
+# in chunks of stream_chunk_size coordinates, if the requested response
+# format supports streaming (see map3d/response_formats.py).
+stream_min_coords = int(os.environ.get('MAP3D_STREAM_MIN_COORDS', 100000))
+stream_chunk_size = int(os.environ.get('MAP3D_STREAM_CHUNK_SIZE', 50000))
+
+# Directory in which asynchronous bulk query jobs (inputs, status and
+# results) are stored, the total disk space (in bytes) that the jobs may
+# use, the largest output (in number of elements) accepted for a job, the
+# number of coordinates processed at a time by the job workers, and how long
+# (in seconds) finished jobs are kept. The space needed by each job is
+# reserved when it is submitted.
+jobs_path = os.environ.get('MAP3D_JOBS_PATH', os.path.join(basedir, 'jobs'))
+jobs_max_bytes = float(os.environ.get('MAP3D_JOBS_MAX_BYTES', 20*1024**3))
+job_max_size = float(os.environ.get('MAP3D_JOB_MAX_SIZE', 2.e7))
+job_chunk_size = int(os.environ.get('MAP3D_JOB_CHUNK_SIZE', 100000))
+job_ttl = float(os.environ.get('MAP3D_JOB_TTL', 7*24*60*60))
+
+# Cache of /api/v2 query responses, stored in Redis. Entries expire after
+# result_cache_ttl seconds, and the least recently used entries are evicted
+# when the cache grows beyond result_cache_max_bytes (compressed). Responses
+# larger than result_cache_max_entry_bytes (compressed) are not cached. Set
+# result_cache_max_bytes to 0 to disable the cache.
+result_cache_ttl = float(os.environ.get('MAP3D_RESULT_CACHE_TTL', 24*60*60))
+result_cache_max_bytes = int(os.environ.get(
+    'MAP3D_RESULT_CACHE_MAX_BYTES', 512*1024**2))
+result_cache_max_entry_bytes = int(os.environ.get(
+    'MAP3D_RESULT_CACHE_MAX_ENTRY_BYTES', 16*1024**2))
+
+# Number of trusted reverse proxies in front of the app (e.g., 1 if serve.py
+# is run behind nginx). If nonzero, the client address (by which clients are
+# rate-limited, and which is logged) is taken from the X-Forwarded-For
+# header: the proxy_count-th address from the right, which was appended by
+# the outermost trusted proxy. Other forwarded headers (X-Forwarded-Proto,
+# -Host, etc.) are not trusted. If zero, X-Forwarded-For is ignored, and
+# each client is identified by the address of its connection.
+proxy_count = int(os.environ.get('MAP3D_PROXY_COUNT', 0))
+
+# The detailed server status (/api/v2/status) is only returned to requests
+# with the header "X-Status-Token: <status_token>" (if status_token is set),
+# or from this host, if there is no proxy (proxy_count = 0) in front of the
+# app. Other clients only get a health flag.
+status_token = os.environ.get('MAP3D_STATUS_TOKEN') or None
+
+# Identical concurrent queries can be coalesced: while one request computes
+# the result, the others wait (for up to coalesce_wait seconds) and reuse it.
+# Waiting requests hold their workers, so this is disabled by default (0),
+# and should only be enabled with threaded workers, and a wait well below the
+# typical query time. Requests that time out compute the result themselves.
+# If the computing request dies, its claim expires after coalesce_lock_ttl
+# seconds.
+coalesce_wait = float(os.environ.get('MAP3D_COALESCE_WAIT', 0.))
+coalesce_lock_ttl = float(os.environ.get('MAP3D_COALESCE_LOCK_TTL', 120.))
+
+# Number of threads used to query several maps at once in a multi-map query
+# (/api/v2/query). Set to 1 to query the maps one after another.
+multi_query_threads = int(os.environ.get('MAP3D_MULTI_QUERY_THREADS', 4))
+
+# Large queries are split into chunks of at least query_chunk_min_coords
+# coordinates, which are queried concurrently using at most query_threads
+# threads per request. Set query_threads to 1 to query all coordinates in
+# the request's own thread.
+query_threads = int(os.environ.get('MAP3D_QUERY_THREADS', 4))
+query_chunk_min_coords = int(os.environ.get('MAP3D_QUERY_CHUNK_MIN_COORDS', 20000))
+
+# Queries of at least this many coordinates are sorted spatially (by nested
+# HEALPix index) before they are queried, so that the map data is read in
+# order. The results are returned in the original order. Set to 0 to
+# disable sorting.
+sort_min_coords = int(os.environ.get('MAP3D_SORT_MIN_COORDS', 10000))
+
+# File in which the coefficients of the query cost model, measured by
+# utils/calibrate_cost_model.py, are stored (see map3d/cost_model.py).
+cost_model_fname = os.environ.get(
+    'MAP3D_COST_MODEL', os.path.join(basedir, 'cost_model.json'))
+
+# Limits on the estimated cost of a query (CPU time in seconds, and peak
+# memory in bytes), by endpoint. Queries that exceed the limits are rejected.
+# The limits can be changed by setting MAP3D_COST_BUDGETS to a JSON object,
+# e.g., '{"api_v2": {"seconds": 20}}'.
+cost_budgets = {
+    'api_v2': {'seconds': 10., 'bytes': 512*1024**2},
+    'api_v2_multi': {'seconds': 10., 'bytes': 512*1024**2}}
+for endpoint, budget in json.loads(
+        os.environ.get('MAP3D_COST_BUDGETS', '{}')).items():
+    cost_budgets.setdefault(endpoint, {}).update(budget)
+
+# Limits on the total cost of the queries made by each client (IP address)
+# to each endpoint in each rate-limit window, in addition to the limits on
+# the number of queries. The cost of a query is the number of elements in
+# its output (coordinates x samples x distances). The limits can be changed
+# by setting MAP3D_RATE_LIMIT_COSTS to a JSON object, e.g.,
+# '{"api_v2": 1e9}'.
+rate_limit_costs = {
+    'api_v2': 1.e8,
+    'api_v2_multi': 1.e8,
+    'api_v2_jobs': 1.e8}
+rate_limit_costs.update(json.loads(os.environ.get('MAP3D_RATE_LIMIT_COSTS', '{}')))
+
+# If greater than 0, each worker process checks most requests against local
+# copies of the rate-limit buckets, rather than Redis, and sends the tokens
+# it has taken to Redis in batches, at least every rate_limit_sync_interval
+# seconds. Between synchronizations, a worker may take at most
+# rate_limit_local_share of the tokens left in a bucket. Requests beyond
+# that (e.g., near the limit) are checked with Redis. Limits are then only
+# approximate across workers. Set to 0 to check every request with Redis.
+rate_limit_sync_interval = float(os.environ.get('MAP3D_RATE_LIMIT_SYNC_INTERVAL', 0.))
+rate_limit_local_share = float(os.environ.get('MAP3D_RATE_LIMIT_LOCAL_SHARE', 0.1))
+
+# Cache of the line-of-sight data (per map pixel) and the encoded postage
+# stamps (per stamp centre, snapped to a grid of los_cache_stamp_snap
+# degrees) returned by the interactive endpoints. Entries are held in an
+# in-process LRU cache of up to los_cache_max_bytes (per cache), and in
+# Redis, for los_cache_ttl seconds. Set los_cache_max_bytes to 0 to disable
+# the cache, or los_cache_stamp_snap to 0 to center stamps exactly.
+los_cache_max_bytes = int(os.environ.get('MAP3D_LOS_CACHE_MAX_BYTES', 64*1024**2))
+los_cache_ttl = float(os.environ.get('MAP3D_LOS_CACHE_TTL', 24*60*60))
+los_cache_stamp_snap = float(os.environ.get('MAP3D_LOS_CACHE_STAMP_SNAP', 0.05))
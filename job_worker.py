@@ -0,0 +1,73 @@
+#!venv/bin/python
+#
+# Runs the asynchronous bulk query jobs submitted to /api/v2/<map>/jobs (see
+# map3d/jobs.py). Workers run at reduced CPU priority, so that interactive
+# queries served by the web workers take precedence. Several workers may run
+# at once (each job is run by only one of them), and jobs that were
+# interrupted (e.g., by a restart) are resumed where they left off.
+#
+
+from __future__ import print_function
+
+import os
+import time
+from multiprocessing import Process
+
+from map3d import mapdata, jobs, reinit_after_fork
+
+
+def work(poll_interval, forked=False):
+    if forked:
+        reinit_after_fork()
+
+    while True:
+        mapdata.check_for_updates()
+        jobs.remove_expired()
+
+        # Run the oldest job that no other worker is running
+        for job_id in jobs.pending():
+            if jobs.run(job_id, mapdata.handlers):
+                break
+        else:
+            time.sleep(poll_interval)
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Run asynchronous bulk query jobs.",
+        add_help=True)
+    parser.add_argument("--processes", "-p", metavar="N",
+                        type=int, default=1,
+                        help="Number of worker processes.")
+    parser.add_argument("--nice", "-n", metavar="INCREMENT",
+                        type=int, default=10,
+                        help="Niceness increment of the workers.")
+    parser.add_argument("--poll-interval", metavar="SECONDS",
+                        type=float, default=5.,
+                        help="How often to check for new jobs.")
+    parser.add_argument("--maps", "-m", metavar="MAP",
+                        type=str, nargs='+', default=[],
+                        help="Maps to load before starting the workers "
+                             "(default: none; maps are loaded on first use).")
+    args = parser.parse_args()
+
+    os.nice(args.nice)
+    mapdata.preload(args.maps)
+
+    if args.processes == 1:
+        work(args.poll_interval)
+        return 0
+
+    procs = [Process(target=work, args=(args.poll_interval, True))
+             for k in range(args.processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,41 @@
 from flask import Flask
 from jinja2 import Environment, PackageLoader
-from config import basedir
+from werkzeug.middleware.proxy_fix import ProxyFix
+from config import basedir, proxy_count
 
 app = Flask(__name__)
 
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 
+# Take the client address from the X-Forwarded-For header set by trusted
+# proxies (and no other forwarded headers)
+if proxy_count > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_count, x_proto=0,
+                            x_host=0, x_port=0, x_prefix=0)
+
 from redis import Redis
 redis = Redis()
 
+
+def reinit_after_fork():
+    """
+    Resets state that must not be shared between processes. Should be called
+    in each worker process forked from a master that has imported the app.
+    """
+    # Drop any connections inherited from the parent, so that each worker
+    # opens its own.
+    redis.connection_pool.reset()
+
+    # Threads are not inherited by forked processes
+    parallel.reset()
+
+    # Drop local rate-limit state inherited from the parent, so that tokens
+    # it has taken are not sent to Redis twice
+    if rate_limit.local_buckets is not None:
+        rate_limit.local_buckets.reset()
+
+
+from map3d import parallel
 from map3d import mapdata
 from map3d import views
+from map3d import rate_limit
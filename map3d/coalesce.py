@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  coalesce.py
+#  Coalescing of identical concurrent requests ("single flight").
+#
+#  The first request with a given key claims it in Redis (with SET NX), and
+#  computes its response as usual. Identical requests that arrive while it
+#  is running wait, and then reuse its response, which is stored briefly in
+#  Redis. If the first request fails (or takes too long), the others compute
+#  their own responses. Coalescing is disabled unless coalesce_wait > 0.
+#
+#  Usage in a view:
+#
+#    response = coalesce.join(key)
+#    if response is not None:
+#        return response
+#    ... compute the response ...
+#    coalesce.publish(key, response)
+#
+
+from __future__ import print_function, division
+
+from map3d import redis
+
+import time
+import zlib
+import uuid
+
+from flask import g, Response, after_this_request
+
+from config import coalesce_wait, coalesce_lock_ttl
+
+
+prefix = 'coalesce/'
+
+# How long (in seconds) a published response is kept for waiting requests
+result_ttl = 10
+
+# How often (in seconds) waiting requests check for the response
+poll_interval = 0.05
+
+
+def _lock_key(key):
+    return prefix + 'lock/' + key
+
+
+def _result_key(key):
+    return prefix + 'result/' + key
+
+
+def join(key):
+    """
+    Joins the flight with the given key. If an identical request is already
+    running, waits (for up to ``coalesce_wait`` seconds) for its response and
+    returns it. Otherwise (or if the wait times out, or the other request
+    fails), returns ``None``, in which case the caller should compute the
+    response, and then pass it to ``publish``.
+    """
+    if coalesce_wait <= 0:
+        return None
+
+    token = uuid.uuid4().hex
+    if redis.set(_lock_key(key), token, nx=True,
+                 px=max(1, int(1000*coalesce_lock_ttl))):
+        # This request computes the response. Release the claim once it has
+        # been sent, whatever the outcome.
+        g._coalesce_key = key
+
+        @after_this_request
+        def release(response):
+            if redis.get(_lock_key(key)) == token.encode('utf-8'):
+                redis.delete(_lock_key(key))
+            return response
+
+        return None
+
+    # Wait for the response of the request that claimed the key
+    t_end = time.time() + coalesce_wait
+    while time.time() < t_end:
+        time.sleep(poll_interval)
+        value = redis.get(_result_key(key))
+        if value is not None:
+            return _decode(value)
+        if not redis.exists(_lock_key(key)):
+            # The other request finished (or failed). Check once more for
+            # its response, as it is published before the claim is released.
+            value = redis.get(_result_key(key))
+            if value is not None:
+                return _decode(value)
+            break
+
+    return None
+
+
+def publish(key, response):
+    """
+    Makes the response of the request that claimed the given key available to
+    the requests waiting for it. Only successful, non-streamed responses are
+    shared.
+    """
+    if getattr(g, '_coalesce_key', None) != key:
+        return
+    if (response.status_code != 200) or response.is_streamed:
+        return
+    value = (response.mimetype.encode('utf-8') + b'\n'
+             + zlib.compress(response.get_data(), 1))
+    redis.set(_result_key(key), value, ex=result_ttl)
+
+
+def _decode(value):
+    mimetype, body = value.split(b'\n', 1)
+    response = Response(zlib.decompress(body), mimetype=mimetype.decode('utf-8'))
+    response.headers['X-Coalesced'] = '1'
+    return response
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  cost_model.py
+#  Estimates of the cost (CPU time and peak memory) of map queries, used to
+#  decide whether to admit them.
+#
+#  The cost of a query is modelled as linear in the number of coordinates
+#  and in the number of output elements, with coefficients that depend on
+#  the map and query mode. The coefficients are measured on the host by
+#  utils/calibrate_cost_model.py, which stores them in cost_model_fname.
+#  Maps and modes that have not been calibrated use conservative defaults.
+#  The cost of encoding the response, which depends on its format, is added
+#  to the cost of the query.
+#
+#  The CPU time model is recalibrated from the timings of the queries that
+#  are run: each (map, mode) has a correction factor, which is an
+#  exponential moving average of the ratio of the measured to the predicted
+#  CPU time. The correction factors are kept in each worker process.
+#
+
+from __future__ import print_function, division
+
+import os
+import json
+import threading
+
+from config import cost_model_fname, cost_budgets
+
+
+# Default coefficients: (per coordinate, per output element)
+default_seconds = {
+    'percentile': (2.e-6, 5.e-5),
+    'median': (2.e-6, 5.e-8),
+    'mean': (2.e-6, 5.e-8),
+    '*': (2.e-6, 1.e-8)}
+default_bytes = {
+    'percentile': (200., 64.),
+    'median': (200., 32.),
+    'mean': (200., 32.),
+    '*': (200., 8.)}
+
+# Cost of encoding each output element: (seconds, bytes)
+encoding_cost = {
+    'application/json': (1.e-6, 100.),
+    '*': (1.e-8, 16.)}
+
+# Weight of each new timing in the moving average of the correction factors
+ema_weight = 0.1
+
+# Queries that take less CPU time than this (in seconds) are too noisy to
+# recalibrate the model
+min_observed_seconds = 0.05
+
+# Range of the correction factors
+min_correction, max_correction = 0.01, 100.
+
+
+_calibration = {}
+_correction = {}
+_lock = threading.Lock()
+
+
+def load_calibration(fname=cost_model_fname):
+    """
+    Loads the calibrated coefficients (written by
+    utils/calibrate_cost_model.py), if the file exists.
+    """
+    global _calibration
+    if os.path.exists(fname):
+        with open(fname, 'r') as f:
+            _calibration = json.load(f)
+
+
+def cpu_time():
+    """
+    Returns the CPU time (user + system) used so far by this process, in
+    seconds, including all of its threads.
+    """
+    t = os.times()
+    return t[0] + t[1]
+
+
+class Cost(object):
+    """
+    Estimated CPU time (in seconds) and peak memory (in bytes) of a query.
+    """
+
+    def __init__(self, seconds=0., n_bytes=0.):
+        self.seconds = seconds
+        self.n_bytes = n_bytes
+
+    def __add__(self, other):
+        return Cost(self.seconds+other.seconds, self.n_bytes+other.n_bytes)
+
+    def __repr__(self):
+        return 'Cost(seconds={:.3g}, n_bytes={:.3g})'.format(
+            self.seconds, self.n_bytes)
+
+
+def query_mode(handler, kwargs):
+    """
+    Returns the mode of a query of the given map handler, with the given
+    keyword arguments.
+    """
+    if 'mode' in handler.get('schema', {}):
+        return kwargs.get('mode', 'random_sample')
+    return 'default'
+
+
+def coefficients(map_name, mode):
+    """
+    Returns the coefficients (per coordinate, per output element) of the CPU
+    time and peak memory of a query of the given map, in the given mode.
+    """
+    cal = _calibration.get(map_name, {}).get(mode)
+    if cal is not None:
+        return tuple(cal['seconds']), tuple(cal['bytes'])
+    return (default_seconds.get(mode, default_seconds['*']),
+            default_bytes.get(mode, default_bytes['*']))
+
+
+def _linear(coeffs, n_coords, n_elements):
+    return coeffs[0]*n_coords + coeffs[1]*n_elements
+
+
+def estimate(map_name, handler, coords, kwargs,
+             mimetype='application/json', chunk_size=None):
+    """
+    Estimates the cost of querying the given map at the given coordinates,
+    with the given keyword arguments, and encoding the result in the given
+    format. If the query is processed in chunks of ``chunk_size``
+    coordinates, only one chunk is assumed to be held in memory at a time.
+    Returns a ``Cost``.
+    """
+    mode = query_mode(handler, kwargs)
+    n_coords = coords.size
+    n_elements = handler['query_size'](coords, **kwargs)
+
+    c_seconds, c_bytes = coefficients(map_name, mode)
+    e_seconds, e_bytes = encoding_cost.get(mimetype, encoding_cost['*'])
+
+    seconds = _linear(c_seconds, n_coords, n_elements) + e_seconds*n_elements
+    seconds *= _correction.get((map_name, mode), 1.)
+
+    if (chunk_size is not None) and (n_coords > chunk_size):
+        n_elements = n_elements * chunk_size / n_coords
+        n_coords = chunk_size
+    n_bytes = _linear(c_bytes, n_coords, n_elements) + e_bytes*n_elements
+
+    return Cost(seconds, n_bytes)
+
+
+def predict_query_seconds(map_name, handler, coords, kwargs):
+    """
+    Returns the calibrated (uncorrected) estimate of the CPU time of a query,
+    excluding the encoding of the response.
+    """
+    c_seconds, _ = coefficients(map_name, query_mode(handler, kwargs))
+    return _linear(c_seconds, coords.size,
+                   handler['query_size'](coords, **kwargs))
+
+
+def observe(map_name, handler, coords, kwargs, seconds):
+    """
+    Updates the correction factor of the CPU time model of the given map and
+    query mode, given the measured CPU time of a query (excluding the
+    encoding of the response).
+    """
+    predicted = predict_query_seconds(map_name, handler, coords, kwargs)
+    if max(predicted, seconds) < min_observed_seconds:
+        return
+
+    ratio = seconds / max(predicted, 1.e-9)
+    ratio = min(max(ratio, min_correction), max_correction)
+
+    key = (map_name, query_mode(handler, kwargs))
+    with _lock:
+        old = _correction.get(key, 1.)
+        _correction[key] = (1.-ema_weight)*old + ema_weight*ratio
+
+
+def check(endpoint, cost):
+    """
+    Checks whether the given cost is within the budget of the given endpoint.
+    Returns ``None`` if it is, or an error message and status code (413) if
+    it is not.
+    """
+    budget = cost_budgets.get(endpoint)
+    if budget is None:
+        return None
+
+    max_seconds = budget.get('seconds', float('inf'))
+    max_bytes = budget.get('bytes', float('inf'))
+    if (cost.seconds <= max_seconds) and (cost.n_bytes <= max_bytes):
+        return None
+
+    msg = ('The estimated cost of this query exceeds the limits of this '
+           'endpoint (estimated: {:.2f} CPU-seconds and {:.0f} MB of memory; '
+           'limits: {:.2f} CPU-seconds and {:.0f} MB). Please split the query '
+           'into smaller queries, or submit it as a bulk query job.')
+    msg = msg.format(cost.seconds, cost.n_bytes/1024**2,
+                     max_seconds, max_bytes/1024**2)
+    return msg, 413
+
+
+def status():
+    """
+    Returns the calibrated coefficients, and the current correction factors
+    of the CPU time model of each map and query mode.
+    """
+    return {
+        'calibrated': _calibration,
+        'correction': {
+            '{}/{}'.format(*k): v
+            for k,v in _correction.items()}}
+
+
+load_calibration()
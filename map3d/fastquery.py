@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fastquery.py
+#  Fast path for bulk queries in Galactic or ICRS coordinates.
+#
+#  Coordinates are held as plain float arrays (rather than as an astropy
+#  SkyCoord), converted from ICRS to Galactic with a fixed rotation matrix,
+#  and passed directly to the map lookup. SkyCoord is only used for other
+#  frames (e.g., FK4), or when the input is already a SkyCoord.
+#
+
+from __future__ import print_function, division
+
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+import astropy.units as units
+from astropy.coordinates import SkyCoord, Distance
+
+import pixquery
+
+
+def lonlat2xyz(lon, lat):
+    """
+    Converts longitude and latitude (in degrees) to unit vectors, with shape
+    (3, ...).
+    """
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    cos_lat = np.cos(lat)
+    return np.array([cos_lat*np.cos(lon), cos_lat*np.sin(lon), np.sin(lat)])
+
+
+def xyz2lonlat(xyz):
+    """
+    Converts unit vectors, with shape (3, ...), to longitude (in [0, 360))
+    and latitude, in degrees.
+    """
+    lon = np.degrees(np.arctan2(xyz[1], xyz[0])) % 360.
+    lat = np.degrees(np.arcsin(np.clip(xyz[2], -1., 1.)))
+    return lon, lat
+
+
+def _icrs_to_gal_matrix():
+    # The columns of the rotation matrix are the images of the ICRS basis
+    # vectors in Galactic coordinates. Let astropy transform them once, so
+    # that the fast path agrees with the SkyCoord path.
+    basis = SkyCoord(
+        [0., 90., 0.]*units.deg,
+        [0., 0., 90.]*units.deg,
+        frame='icrs').transform_to('galactic')
+    return lonlat2xyz(basis.l.deg, basis.b.deg)
+
+icrs_to_gal_matrix = _icrs_to_gal_matrix()
+
+
+def icrs_to_gal(ra, dec):
+    """
+    Converts ICRS (ra, dec) to Galactic (l, b). All angles in degrees.
+    """
+    xyz = lonlat2xyz(ra, dec)
+    s = xyz.shape
+    xyz = np.dot(icrs_to_gal_matrix, xyz.reshape(3, -1)).reshape(s)
+    return xyz2lonlat(xyz)
+
+
+class GalCoords(object):
+    """
+    Galactic coordinates, stored as plain float arrays: ``l`` and ``b``, in
+    degrees, and (optionally) distance ``d``, in kpc. Provides the subset of
+    the SkyCoord interface used by the size checkers.
+    """
+
+    def __init__(self, l, b, d=None):
+        self.l = np.asarray(l, dtype='f8')
+        self.b = np.asarray(b, dtype='f8')
+        self.d = None
+        if d is not None:
+            self.d = np.broadcast_to(np.asarray(d, dtype='f8'), self.l.shape)
+
+    @classmethod
+    def from_icrs(cls, ra, dec, d=None):
+        l, b = icrs_to_gal(ra, dec)
+        return cls(l, b, d=d)
+
+    @classmethod
+    def from_skycoord(cls, coords):
+        if coords.frame.name != 'galactic':
+            coords = coords.transform_to('galactic')
+        d = None
+        if hasattr(coords.distance, 'kpc'):
+            d = coords.distance.kpc
+        return cls(coords.l.deg, coords.b.deg, d=d)
+
+    shape = property(lambda self: self.l.shape)
+    size = property(lambda self: self.l.size)
+    isscalar = property(lambda self: self.l.ndim == 0)
+
+    def __len__(self):
+        return len(self.l)
+
+    @property
+    def distance(self):
+        if self.d is None:
+            return None
+        return Distance(self.d, unit=units.kpc)
+
+    def flat(self):
+        """
+        Returns flattened (l, b, d) arrays (d may be None). Scalar coordinates
+        are returned as arrays of length 1.
+        """
+        l = np.ravel(self.l)
+        b = np.ravel(self.b)
+        d = None if self.d is None else np.ravel(self.d)
+        return l, b, d
+
+    def chunks(self, chunk_size):
+        """
+        Yields consecutive chunks of at most ``chunk_size`` of the flattened
+        coordinates, as GalCoords objects.
+        """
+        l, b, d = self.flat()
+        for k in range(0, l.size, chunk_size):
+            s = slice(k, k+chunk_size)
+            yield GalCoords(l[s], b[s], d=None if d is None else d[s])
+
+    def take(self, idx):
+        """
+        Returns the flattened coordinates with the given indices, as a
+        GalCoords object.
+        """
+        l, b, d = self.flat()
+        return GalCoords(l[idx], b[idx], d=None if d is None else d[idx])
+
+    def to_skycoord(self):
+        return SkyCoord(
+            self.l*units.deg,
+            self.b*units.deg,
+            distance=self.distance,
+            frame='galactic')
+
+
+def spatial_order(coords, nside=1024):
+    """
+    Returns the order in which to query the given (flattened) coordinates, so
+    that nearby coordinates are queried together: sorted by nested HEALPix
+    index. The first coordinate is kept first, so that the output dtype is
+    the same as for the unsorted coordinates (see
+    ``pixquery.query_pix_unique``).
+    """
+    l, b, d = coords.flat()
+    order = np.argsort(pixquery.lb2pix(nside, l, b, nest=True), kind='mergesort')
+    if order.size and order[0] != 0:
+        order = np.concatenate([[0], order[order != 0]])
+    return order
+
+
+def as_gal(coords):
+    if isinstance(coords, GalCoords):
+        return coords
+    return GalCoords.from_skycoord(coords)
+
+
+def as_skycoord(coords):
+    if isinstance(coords, GalCoords):
+        return coords.to_skycoord()
+    return coords
+
+
+def reshape_output(out, coords):
+    """
+    Reshapes the output of a query of flattened coordinates to match the
+    shape of the coordinates (in the same way as dustmaps does).
+    """
+    if not coords.isscalar:
+        if isinstance(out, (list, tuple)):
+            return type(out)(
+                np.reshape(o, coords.shape + o.shape[1:]) for o in out)
+        return np.reshape(out, coords.shape + out.shape[1:])
+
+    if isinstance(out, (list, tuple)):
+        return [o[0] for o in out]
+    return out[0]
+
+
+def bayestar_query(q, coords, ipix_cache=None, **kwargs):
+    """
+    Queries a Bayestar map at the given coordinates (a GalCoords object). The
+    keyword arguments and output are the same as for BayestarQuery.query.
+    HEALPix pixel indices of the coordinates can be shared between queries of
+    several maps by passing the same dictionary as ``ipix_cache`` (see
+    ``pixquery.find_pix_idx``).
+    """
+    l, b, d = coords.flat()
+    pix_idx = pixquery.find_pix_idx(q, l, b, ipix_cache=ipix_cache)
+    out = pixquery.query_pix_summary(q, pix_idx, d=d, **kwargs)
+    if out is None:
+        out = pixquery.query_pix_unique(q, pix_idx, d=d, **kwargs)
+    return reshape_output(out, coords)
+
+
+def bayestar_query_samples_best(q, coords):
+    """
+    Queries the samples, best fit and flags of a Bayestar map at the given
+    coordinates (a GalCoords object), with a single pixel lookup. Returns
+    (samples, best, flags), in the same formats as BayestarQuery.query.
+    """
+    l, b, d = coords.flat()
+    pix_idx = pixquery.find_pix_idx(q, l, b)
+    out = pixquery.query_pix_samples_best(q, pix_idx, d=d)
+    return reshape_output(out, coords)
+
+
+def sfd_query(q, coords, order=1, ipix_cache=None):
+    """
+    Queries an SFD-like map at the given coordinates (a GalCoords object), in
+    the same way as SFDQuery.query. ``ipix_cache`` is accepted for
+    compatibility with ``bayestar_query``, but is not used.
+    """
+    l, b, d = coords.flat()
+    out = np.full(len(l), np.nan, dtype='f4')
+
+    for pole in q.poles:
+        m = (b >= 0) if pole == 'ngp' else (b < 0)
+
+        if np.any(m):
+            data, w = q._data[pole]
+            x, y = w.wcs_world2pix(l[m], b[m], 0)
+            out[m] = map_coordinates(data, [y, x], order=order, mode='nearest')
+
+    return reshape_output(out, coords)
@@ -12,8 +12,27 @@
 from flask import after_this_request, request
 from cStringIO import StringIO as IO
 import gzip
+import zlib
 import functools 
 
+
+def gzip_stream(chunks, level):
+    """
+    Compresses an iterable of byte strings incrementally, yielding the
+    pieces of a gzip stream.
+    """
+    z = zlib.compressobj(level, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            data = z.compress(chunk)
+            if data:
+                yield data
+        yield z.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
 def gzipped(level):
     
     def decorator(f):
@@ -33,6 +52,14 @@ def gzipped(level):
                     'Content-Encoding' in response.headers):
                     return response
                 
+                # Compress streamed responses as they are sent
+                if response.is_streamed:
+                    response.response = gzip_stream(response.response, level)
+                    response.headers['Content-Encoding'] = 'gzip'
+                    response.vary.add('Accept-Encoding')
+                    response.headers.pop('Content-Length', None)
+                    return response
+                
                 gzip_buffer = IO()
                 gzip_file = gzip.GzipFile(mode='wb', 
                                           fileobj=gzip_buffer,
@@ -42,7 +69,7 @@ def gzipped(level):
                 
                 response.data = gzip_buffer.getvalue()
                 response.headers['Content-Encoding'] = 'gzip'
-                response.headers['Vary'] = 'Accept-Encoding'
+                response.vary.add('Accept-Encoding')
                 response.headers['Content-Length'] = len(response.data)
                 
                 return response
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  jobs.py
+#  Asynchronous bulk query jobs, stored on local disk.
+#
+#  Each job is a directory in the jobs directory, containing the input
+#  coordinates (l.npy, b.npy and, optionally, d.npy), the job description
+#  and status (job.json), and the results (result.npy, in the same format as
+#  the .npy responses of the synchronous API).
+#
+#  Jobs are run by separate worker processes (see job_worker.py), which
+#  process the coordinates in chunks, writing the results directly to a
+#  memory-mapped .npy file. The number of coordinates processed is recorded
+#  after each chunk, so that a job that was interrupted (e.g., because its
+#  worker was restarted) resumes where it left off. A lock file ensures that
+#  each job is run by only one worker at a time.
+#
+#  The disk space that each job will need is estimated, and reserved when
+#  the job is submitted, so that the jobs never use more than jobs_max_bytes
+#  in total.
+#
+
+from __future__ import print_function, division
+
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import traceback
+
+import numpy as np
+
+from config import jobs_path, jobs_max_bytes, job_chunk_size, job_ttl
+
+import fastquery
+import response_formats
+
+
+job_id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+
+def job_dir(job_id):
+    return os.path.join(jobs_path, job_id)
+
+
+def job_fname(job_id, fname):
+    return os.path.join(jobs_path, job_id, fname)
+
+
+def result_fname(job_id):
+    return job_fname(job_id, 'result.npy')
+
+
+def _write_json(fname, d):
+    # Write atomically, so that readers never see a partial file
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(d, f, indent=2, sort_keys=True)
+    os.rename(tmp_fname, fname)
+
+
+def estimate_bytes(coords, n_elements):
+    """
+    Returns an upper bound on the disk space (in bytes) needed by a job with
+    the given coordinates (a GalCoords object) and number of output elements:
+    the input coordinates, and the results (at most 8 bytes per element) and
+    flags.
+    """
+    n_coord_arrays = 2 if coords.d is None else 3
+    return int(8*n_elements + (8*n_coord_arrays + 16)*coords.size + 4096)
+
+
+def _dir_bytes(dirname):
+    n_bytes = 0
+    for fname in os.listdir(dirname):
+        try:
+            n_bytes += os.path.getsize(os.path.join(dirname, fname))
+        except OSError:
+            pass
+    return n_bytes
+
+
+def disk_usage():
+    """
+    Returns the disk space (in bytes) used or reserved by the stored jobs.
+    """
+    if not os.path.isdir(jobs_path):
+        return 0
+    n_bytes = 0
+    for job_id in os.listdir(jobs_path):
+        job = get(job_id)
+        if job is not None:
+            n_bytes += max(job.get('n_bytes', 0), _dir_bytes(job_dir(job_id)))
+    return n_bytes
+
+
+def create(map_name, coords, kwargs, n_bytes):
+    """
+    Stores a new job, querying the given map at the given coordinates (a
+    GalCoords object), with the given keyword arguments, and reserves
+    ``n_bytes`` of disk space for it (see ``estimate_bytes``). Returns the
+    job ID, or ``None`` if there is not enough space left for the job.
+    """
+    if not os.path.isdir(jobs_path):
+        os.makedirs(jobs_path)
+
+    # Check and reserve the space under a lock, so that concurrent
+    # submissions cannot exceed the quota together
+    with open(os.path.join(jobs_path, '.quota.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if disk_usage() + n_bytes > jobs_max_bytes:
+                return None
+            return _create(map_name, coords, kwargs, n_bytes)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _create(map_name, coords, kwargs, n_bytes):
+    job_id = uuid.uuid4().hex
+
+    tmp_dirname = os.path.join(jobs_path, '.{}.tmp'.format(job_id))
+    os.makedirs(tmp_dirname)
+
+    l, b, d = coords.flat()
+    np.save(os.path.join(tmp_dirname, 'l.npy'), l)
+    np.save(os.path.join(tmp_dirname, 'b.npy'), b)
+    if d is not None:
+        np.save(os.path.join(tmp_dirname, 'd.npy'), d)
+
+    kwargs = {
+        k: v.tolist() if isinstance(v, np.ndarray) else v
+        for k,v in kwargs.items()}
+
+    _write_json(os.path.join(tmp_dirname, 'job.json'), {
+        'id': job_id,
+        'map': map_name,
+        'kwargs': kwargs,
+        'shape': list(coords.shape),
+        'n_coords': int(coords.size),
+        'n_bytes': int(n_bytes),
+        'n_done': 0,
+        'status': 'queued',
+        'error': None,
+        'created': time.time(),
+        'started': None,
+        'finished': None})
+
+    os.rename(tmp_dirname, job_dir(job_id))
+
+    return job_id
+
+
+def get(job_id):
+    """
+    Returns the description and status of the given job, or ``None`` if it
+    does not exist.
+    """
+    if not job_id_pattern.match(job_id):
+        return None
+    fname = job_fname(job_id, 'job.json')
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def status(job_id):
+    """
+    Returns the status of the given job, as reported by the API, or ``None``
+    if it does not exist.
+    """
+    job = get(job_id)
+    if job is None:
+        return None
+    keys = ['id', 'map', 'status', 'error', 'n_coords', 'n_done',
+            'created', 'started', 'finished']
+    res = {k: job[k] for k in keys}
+    res['progress'] = job['n_done'] / max(1, job['n_coords'])
+    return res
+
+
+def pending():
+    """
+    Returns the IDs of all jobs that have not finished, oldest first.
+    """
+    if not os.path.isdir(jobs_path):
+        return []
+    jobs = [get(job_id) for job_id in os.listdir(jobs_path)]
+    jobs = [j for j in jobs if (j is not None)
+                               and (j['status'] in ('queued', 'running'))]
+    jobs.sort(key=lambda j: j['created'])
+    return [j['id'] for j in jobs]
+
+
+def remove_expired():
+    """
+    Removes jobs that finished more than ``job_ttl`` seconds ago.
+    """
+    if not os.path.isdir(jobs_path):
+        return
+    t = time.time()
+    for job_id in os.listdir(jobs_path):
+        job = get(job_id)
+        if (job is not None) and (job['finished'] is not None) \
+                and (t - job['finished'] > job_ttl):
+            print('Removing expired job {} ...'.format(job_id))
+            shutil.rmtree(job_dir(job_id), ignore_errors=True)
+
+
+def run(job_id, handlers):
+    """
+    Runs (or resumes) the given job, if no other worker is running it.
+    ``handlers`` is the dictionary of map handlers (see mapdata.py). Returns
+    ``True`` if the job was run by this process.
+    """
+    try:
+        lock_file = open(job_fname(job_id, 'lock'), 'w')
+    except IOError:
+        # The job directory has been removed
+        return False
+
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+
+        try:
+            # The job may have been deleted (or have expired) since it was
+            # queued
+            job = get(job_id)
+            if (job is None) or (job['status'] not in ('queued', 'running')):
+                return False
+            try:
+                _run(job, handlers)
+            except Exception as err:
+                traceback.print_exc()
+                job['status'] = 'failed'
+                job['error'] = str(err)
+                job['finished'] = time.time()
+                _write_json(job_fname(job_id, 'job.json'), job)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return True
+
+
+def _run(job, handlers):
+    job_id = job['id']
+    json_fname = job_fname(job_id, 'job.json')
+    partial_fname = result_fname(job_id) + '.partial'
+
+    handler = handlers[job['map']]
+    q = handler['q']
+    kwargs = job['kwargs']
+
+    l = np.load(job_fname(job_id, 'l.npy'), mmap_mode='r')
+    b = np.load(job_fname(job_id, 'b.npy'), mmap_mode='r')
+    d = None
+    if os.path.exists(job_fname(job_id, 'd.npy')):
+        d = np.load(job_fname(job_id, 'd.npy'), mmap_mode='r')
+
+    # In "random_sample_per_pix" mode, coordinates in the same pixel have to
+    # get the same sample, even if they are in different chunks. Unseeded
+    # jobs are therefore given a random seed (stored with the job, so that it
+    # is also used if the job is resumed).
+    if (kwargs.get('mode') == 'random_sample_per_pix') and \
+            (kwargs.get('seed') is None):
+        kwargs['seed'] = int(np.random.randint(0, 2**62))
+    chunk_size = job_chunk_size
+
+    # Resume from the last chunk written
+    n_done = job['n_done']
+    if not os.path.exists(partial_fname):
+        n_done = 0
+    out = None
+    if n_done > 0:
+        out = np.lib.format.open_memmap(partial_fname, mode='r+')
+
+    job['status'] = 'running'
+    job['started'] = job['started'] or time.time()
+    job['n_done'] = n_done
+    _write_json(json_fname, job)
+
+    while n_done < job['n_coords']:
+        s = slice(n_done, n_done+chunk_size)
+        coords = fastquery.GalCoords(
+            l[s], b[s],
+            d=None if d is None else d[s])
+
+        if 'query_gal' in handler:
+            res = handler['query_gal'](q, coords, **kwargs)
+        else:
+            res = q(coords.to_skycoord(), **kwargs)
+        arr = response_formats.npy_array(res, 1)
+
+        # The results are stored with the shape of the input coordinates,
+        # and written through a flattened view.
+        if out is None:
+            out = np.lib.format.open_memmap(
+                partial_fname,
+                mode='w+',
+                dtype=arr.dtype,
+                shape=tuple(job['shape']) + arr.shape[1:])
+        out_flat = out.reshape((job['n_coords'],) + out.shape[len(job['shape']):])
+        out_flat[s] = arr
+        out.flush()
+
+        n_done += len(arr)
+        job['n_done'] = n_done
+        _write_json(json_fname, job)
+
+    out = out_flat = None
+    os.rename(partial_fname, result_fname(job_id))
+
+    job['status'] = 'done'
+    job['finished'] = time.time()
+    _write_json(json_fname, job)
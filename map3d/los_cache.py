@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  los_cache.py
+#  Cache of the line-of-sight data and postage stamps returned by the
+#  interactive endpoints.
+#
+#  The line-of-sight data (samples, best fit and flags) only depend on the
+#  map pixel that a coordinate falls in, and are cached per (map, pixel).
+#  The encoded postage stamps are cached per (map, stamp centre), with the
+#  centre snapped to a fine grid, so that clicks that are close together
+#  share stamps (the responses report the centre of the stamps, which may
+#  differ slightly from the queried coordinates). Both include the signature
+#  of the loaded map file in their keys, so that reloading a map invalidates
+#  its entries.
+#
+#  Entries are held in an in-process LRU cache, and in Redis (for a fixed
+#  time), so that they are shared by the worker processes.
+#
+
+from __future__ import print_function, division
+
+from map3d import redis
+
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from cStringIO import StringIO as IO
+
+import numpy as np
+
+from config import los_cache_max_bytes, los_cache_ttl, los_cache_stamp_snap
+
+import fastquery
+import pixquery
+import postage_stamp
+
+
+prefix = 'los-cache/'
+
+
+class LRUCache(object):
+    """
+    In-process least-recently-used cache, limited by the total size of its
+    values, in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict()   # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.n_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                _, (_, s) = self._entries.popitem(last=False)
+                self.n_bytes -= s
+
+
+class TwoLevelCache(object):
+    """
+    Cache held in an in-process LRU cache, backed by Redis. Values are
+    serialized (for Redis, and to measure their sizes) by ``encode`` and
+    ``decode``.
+    """
+
+    def __init__(self, name, encode, decode):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+        self.local = LRUCache(los_cache_max_bytes)
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    enabled = property(lambda self: los_cache_max_bytes > 0)
+
+    def _redis_key(self, key):
+        return prefix + self.name + '/' + key
+
+    def _count(self, counter):
+        # The counters are shared by the request threads
+        with self.local._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        """
+        Returns the cached value with the given key, or ``None``.
+        """
+        if not self.enabled:
+            return None
+
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+
+        data = redis.get(self._redis_key(key))
+        if data is not None:
+            value = self.decode(data)
+            self.local.put(key, value, len(data))
+            self._count('redis_hits')
+            return value
+
+        self._count('misses')
+        return None
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        data = self.encode(value)
+        self.local.put(key, value, len(data))
+        # In milliseconds, so that fractional TTLs (even below 1 s) are kept
+        redis.set(self._redis_key(key), data,
+                  px=max(1, int(1000*los_cache_ttl)))
+
+    def stats(self):
+        with self.local._lock:
+            n_entries, n_bytes = len(self.local), self.local.n_bytes
+            local_hits, redis_hits, misses = (
+                self.local_hits, self.redis_hits, self.misses)
+        n_requests = local_hits + redis_hits + misses
+        return {
+            'entries': n_entries,
+            'bytes': n_bytes,
+            'max_bytes': self.local.max_bytes,
+            'local_hits': local_hits,
+            'redis_hits': redis_hits,
+            'misses': misses,
+            'hit_ratio': (
+                (local_hits + redis_hits) / n_requests
+                if n_requests else None)}
+
+
+def _encode_arrays(arrs):
+    f = IO()
+    for a in arrs:
+        np.save(f, a, allow_pickle=False)
+    return f.getvalue()
+
+
+def _decode_arrays(data, n=3):
+    f = IO(data)
+    return tuple(np.load(f, allow_pickle=False) for k in range(n))
+
+
+def _encode_json(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def _decode_json(data):
+    return json.loads(data.decode('utf-8'))
+
+
+los = TwoLevelCache('los', _encode_arrays, _decode_arrays)
+stamps = TwoLevelCache('stamps', _encode_json, _decode_json)
+
+
+def _signature_key(map_name, signature):
+    h = hashlib.sha1(json.dumps(signature, sort_keys=True).encode('utf-8'))
+    return '{}/{}'.format(map_name, h.hexdigest()[:16])
+
+
+def samples_best(map_name, signature, q, coords):
+    """
+    Returns the samples, best fit and flags of the Bayestar map ``q`` at the
+    given scalar coordinates (a GalCoords object, without distance), in the
+    same formats as ``fastquery.bayestar_query_samples_best``. ``signature``
+    is the signature of the file that ``q`` was loaded from, as returned
+    (together with ``q``) by ``LazyMap.get_signed``.
+    """
+    l, b, d = coords.flat()
+    pix_idx = pixquery.find_pix_idx(q, l, b)
+    key = '{}/{:d}'.format(_signature_key(map_name, signature), int(pix_idx[0]))
+
+    out = los.get(key)
+    if out is None:
+        out = pixquery.query_pix_samples_best(q, pix_idx)
+        los.put(key, out)
+
+    # Return copies, which the caller may modify
+    return fastquery.reshape_output([np.copy(x) for x in out], coords)
+
+
+def snap(l, b):
+    """
+    Snaps a stamp centre (l, b), in degrees, to the grid on which stamps are
+    cached.
+    """
+    if los_cache_stamp_snap <= 0:
+        return l, b
+    l = (np.round(l / los_cache_stamp_snap) * los_cache_stamp_snap) % 360.
+    b = np.clip(np.round(b / los_cache_stamp_snap) * los_cache_stamp_snap,
+                -90., 90.)
+    return float(l), float(b)
+
+
+def encoded_stamps(map_name, signature, l, b, dists):
+    """
+    Returns the encoded postage stamps of the given map around (l, b) (in
+    degrees), at the given distances (in pc), and the centre (l, b) of the
+    stamps. If the stamps are cached, the centre is snapped to the cache
+    grid.
+    """
+    if not stamps.enabled:
+        img = postage_stamp.postage_stamps(map_name, l, b, dists=dists)
+        return [postage_stamp.encode_image(img_d) for img_d in img], (l, b)
+
+    l, b = snap(l, b)
+    key = '{}/{!r}/{!r}/{}'.format(
+        _signature_key(map_name, signature), l, b,
+        ','.join('{:g}'.format(d) for d in dists))
+
+    img = stamps.get(key)
+    if img is None:
+        img = postage_stamp.postage_stamps(map_name, l, b, dists=dists)
+        img = [postage_stamp.encode_image(img_d) for img_d in img]
+        stamps.put(key, img)
+
+    return img, (l, b)
+
+
+def stats():
+    """
+    Returns the sizes and hit counts of the caches in this process.
+    """
+    return {
+        'los': los.stats(),
+        'stamps': stamps.stats()}
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  map_cache.py
+#  Persistent on-disk cache of arrays derived from the map files.
+#
+#  Arrays are stored as .npy files in the cache directory, and are
+#  memory-mapped (read-only) when loaded. Each entry is keyed by a hash of
+#  the inputs used to generate it (including the size, modification time
+#  and a partial hash of the source map file), so that stale entries are
+#  detected and rebuilt automatically.
+#
+#  Because the arrays are memory-mapped, all processes on a host that load
+#  the same entry share one physical copy of it (in the page cache).
+#
+
+from __future__ import print_function, division
+
+import os
+import re
+import json
+import fcntl
+import shutil
+import hashlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy as np
+
+from config import cache_path
+
+
+# Increment to invalidate all existing cache entries
+cache_version = 1
+
+
+def file_signature(fname, n_bytes=1024**2):
+    """
+    Returns a signature that changes whenever the given file changes. The
+    signature contains the file size, the modification time, and a hash of
+    the first and last ``n_bytes`` of the file (hashing the entire file would
+    take too long for the multi-gigabyte map files).
+    """
+    st = os.stat(fname)
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        h.update(f.read(n_bytes))
+        if st.st_size > n_bytes:
+            f.seek(max(n_bytes, st.st_size-n_bytes))
+            h.update(f.read(n_bytes))
+    return {
+        'fname': os.path.basename(fname),
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'sha1': h.hexdigest()
+    }
+
+
+def cache_key(*parts):
+    """
+    Returns a hash of the given (JSON-serializable) inputs.
+    """
+    txt = json.dumps([cache_version] + list(parts), sort_keys=True)
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()[:16]
+
+
+def entry_fname(name, key, ext='.npy'):
+    return os.path.join(cache_path, '{}-{}{}'.format(name, key, ext))
+
+
+def remove_stale(name, key):
+    """
+    Removes all entries with the given name, except for the one with the
+    given key.
+    """
+    pattern = re.compile(
+        r'^{}-[0-9a-f]{{16}}(\.npy|\.json)?$'.format(re.escape(name)))
+    keep = os.path.basename(entry_fname(name, key, ext=''))
+    for fn in os.listdir(cache_path):
+        if (not pattern.match(fn)) or fn.startswith(keep):
+            continue
+        fname = os.path.join(cache_path, fn)
+        print('Removing stale cache entry {} ...'.format(fname))
+        if os.path.isdir(fname):
+            shutil.rmtree(fname)
+        else:
+            os.remove(fname)
+
+
+def load(name, key):
+    """
+    Memory-maps the given cache entry (read-only), or returns ``None`` if it
+    does not exist.
+    """
+    fname = entry_fname(name, key)
+    if not os.path.exists(fname):
+        return None
+    return np.load(fname, mmap_mode='r')
+
+
+def save(name, key, arr):
+    """
+    Writes an array to the cache. The file is first written to a temporary
+    location and then moved into place, so that readers never see partially
+    written entries.
+    """
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+    fname = entry_fname(name, key)
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        np.save(f, arr)
+    os.rename(tmp_fname, fname)
+
+
+def load_object(name, key):
+    """
+    Loads an object stored by ``save_object``, with its arrays memory-mapped
+    read-only. Returns ``None`` if the entry does not exist.
+    """
+    dirname = entry_fname(name, key, ext='')
+    if not os.path.isdir(dirname):
+        return None
+
+    with open(os.path.join(dirname, 'state.pkl'), 'rb') as f:
+        state = pickle.load(f)
+
+    attrs = state['attrs']
+    for attr in state['arrays']:
+        attrs[attr] = np.load(
+            os.path.join(dirname, attr+'.npy'),
+            mmap_mode='r')
+    for attr, n in state['array_lists'].items():
+        attrs[attr] = [
+            np.load(os.path.join(dirname, '{}.{}.npy'.format(attr, k)),
+                    mmap_mode='r')
+            for k in range(n)]
+
+    obj = state['cls'].__new__(state['cls'])
+    obj.__dict__.update(attrs)
+    return obj
+
+
+def save_object(name, key, obj, min_array_size=1024**2):
+    """
+    Writes an object's attributes to the cache. Large arrays (and lists of
+    arrays) are stored as individual .npy files, so that they can be
+    memory-mapped. All other attributes are pickled.
+    """
+    dirname = entry_fname(name, key, ext='')
+    tmp_dirname = '{}.{}.tmp'.format(dirname, os.getpid())
+    os.makedirs(tmp_dirname)
+
+    def is_large_array(x):
+        return isinstance(x, np.ndarray) and (x.nbytes >= min_array_size)
+
+    state = {
+        'cls': obj.__class__,
+        'attrs': {},
+        'arrays': [],
+        'array_lists': {}
+    }
+
+    for attr, val in obj.__dict__.items():
+        if is_large_array(val):
+            np.save(os.path.join(tmp_dirname, attr+'.npy'), val)
+            state['arrays'].append(attr)
+        elif (isinstance(val, list) and len(val)
+              and all(isinstance(x, np.ndarray) for x in val)
+              and any(is_large_array(x) for x in val)):
+            for k,x in enumerate(val):
+                np.save(os.path.join(tmp_dirname, '{}.{}.npy'.format(attr, k)), x)
+            state['array_lists'][attr] = len(val)
+        else:
+            state['attrs'][attr] = val
+
+    with open(os.path.join(tmp_dirname, 'state.pkl'), 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.rename(tmp_dirname, dirname)
+
+
+def _cached(load_fn, save_fn, name, key, build, meta):
+    obj = load_fn(name, key)
+    if obj is not None:
+        return obj
+
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+
+    with open(os.path.join(cache_path, name+'.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # Another process may have built the entry while we waited
+            obj = load_fn(name, key)
+            if obj is None:
+                save_fn(name, key, build())
+                if meta is not None:
+                    with open(entry_fname(name, key, ext='.json'), 'w') as f:
+                        json.dump(meta, f, indent=2, sort_keys=True)
+                remove_stale(name, key)
+                obj = load_fn(name, key)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return obj
+
+
+def cached_array(name, key, build, meta=None):
+    """
+    Returns the cached array with the given name and key, memory-mapped
+    read-only. If no such entry exists, the array is generated by calling
+    ``build()`` and written to the cache, and stale entries with the same
+    name are removed. A lock file ensures that only one process builds a
+    given entry at a time.
+    """
+    return _cached(load, save, name, key, build, meta)
+
+
+def cached_object(name, key, build, meta=None):
+    """
+    Like ``cached_array``, but for objects (e.g., map query objects) whose
+    large array attributes should be memory-mapped.
+    """
+    return _cached(load_object, save_object, name, key, build, meta)
@@ -1,6 +1,8 @@
 from __future__ import print_function, division
 
 import os
+import time
+import threading
 import h5py
 import numpy as np
 
@@ -10,43 +12,241 @@ from dustmaps.planck import PlanckQuery
 from dustmaps.marshall import MarshallQuery
 
 import validators
+import map_cache
+import pixquery
+import fastquery
+from config import preload_maps, share_maps, reload_check_interval
 
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 data_path = os.path.join(script_dir, 'static', 'data')
 
 
+class LazyMap(object):
+    """
+    Loads a map's query object the first time it is needed. Concurrent first
+    requests wait on a lock, so that each map is only loaded once.
+
+    If the map is read from a single file (``fname``), the signature of the
+    file that was loaded is recorded, so that changes to the file can be
+    detected, and the map reloaded.
+    """
+
+    def __init__(self, name, load, fname=None):
+        self.name = name
+        self.fname = fname
+        self._load = load
+        self._current = (None, None)    # (query object, signature)
+        self._lock = threading.Lock()
+        self.load_time = None
+
+    # The query object and the signature are replaced together, so that a
+    # single read of _current always returns a consistent pair
+    _obj = property(lambda self: self._current[0])
+    signature = property(lambda self: self._current[1])
+
+    @property
+    def loaded(self):
+        return self._obj is not None
+
+    def file_signature(self):
+        if self.fname is None:
+            return None
+        return map_cache.file_signature(self.fname)
+
+    def load_new(self):
+        """
+        Loads a new copy of the map from disk, without swapping it in.
+        Returns the query object and the signature of the file it was loaded
+        from.
+        """
+        print('Loading {} ...'.format(self.name))
+        t0 = time.time()
+        signature = self.file_signature()
+        obj = self._load()
+        self.load_time = time.time() - t0
+        print('Loaded {} ({:.1f} s).'.format(self.name, self.load_time))
+        return obj, signature
+
+    def swap(self, obj, signature):
+        """
+        Replaces the query object. Requests that already hold a reference to
+        the old object continue to use it.
+        """
+        with self._lock:
+            self._current = (obj, signature)
+
+    def get_signed(self):
+        """
+        Returns the query object, and the signature of the file it was loaded
+        from. Use this (rather than reading ``signature`` separately) when
+        results are stored under the signature, as the map may be reloaded
+        in between.
+        """
+        current = self._current
+        if current[0] is None:
+            with self._lock:
+                if self._current[0] is None:
+                    self._current = self.load_new()
+                current = self._current
+        return current
+
+    def get(self):
+        return self.get_signed()[0]
+
+
+class MapHandler(dict):
+    """
+    An entry in ``handlers``. The query object, stored under the key 'q', is
+    a ``LazyMap``, which is loaded when the entry is first accessed.
+    """
+
+    def __init__(self, q, **kwargs):
+        super(MapHandler, self).__init__(q=q, **kwargs)
+        self.lazy_q = q
+
+    def __getitem__(self, key):
+        if key == 'q':
+            return self.lazy_q.get()
+        return super(MapHandler, self).__getitem__(key)
+
+
+class LazyImageData(dict):
+    """
+    Dictionary of map images (used to generate postage stamps), which are
+    generated the first time they are requested.
+    """
+
+    def __init__(self, builders):
+        super(LazyImageData, self).__init__()
+        self._builders = builders
+        self._locks = {k: threading.Lock() for k in builders}
+
+    def __missing__(self, key):
+        with self._locks[key]:
+            if not dict.__contains__(self, key):
+                self[key] = self._builders[key]()
+        return dict.__getitem__(self, key)
+
+    def available(self):
+        return list(self._builders.keys())
+
+
 def gen_images(q, nside, dists, **kwargs):
     import healpy as hp
     n_pix = hp.pixelfunc.nside2npix(nside)
     l,b = hp.pixelfunc.pix2ang(nside, np.arange(n_pix),
                                lonlat=True, nest=True)
-    img = np.vstack([q.query_gal(l, b, d=d, **kwargs) for d in dists])
+    if isinstance(q, BayestarQuery):
+        # Look up the map pixels once, and reuse them at every distance
+        pix_idx = pixquery.find_pix_idx(q, l, b)
+        img = np.vstack(pixquery.query_pix_dists(q, pix_idx, dists, **kwargs))
+    else:
+        img = np.vstack([q.query_gal(l, b, d=d, **kwargs) for d in dists])
     return nside, img.T
 
 
-print('Loading Bayestar2015 ...')
-bayestar2015 = BayestarQuery(
-    map_fname=os.path.join(data_path, 'bayestar2015.h5'),
-    max_samples=5)
-print('Loading Bayestar2017 ...')
-bayestar2017 = BayestarQuery(
-    map_fname=os.path.join(data_path, 'bayestar2017.h5'),
-    max_samples=5)
-print('Loading Bayestar2019 ...')
-bayestar2019 = BayestarQuery(
-    map_fname=os.path.join(data_path, 'bayestar2019.h5'),
-    max_samples=5)
-print('Loading SFD ...')
-sfd = SFDQuery(map_dir=data_path)
+def load_summary(q, fname, source, max_samples):
+    """
+    Attaches the precomputed summary statistics of a Bayestar map's samples
+    (see utils/create_summary_cubes.py) to its query object, if they were
+    computed from the same map file and number of samples.
+    """
+    with h5py.File(fname, 'r') as f:
+        if ((f.attrs['source_size'] != source['size']) or
+            (f.attrs['source_sha1'] != source['sha1']) or
+            (f.attrs['max_samples'] != max_samples)):
+            print('Ignoring {}, which was computed from a different map '
+                  'file or number of samples.'.format(fname))
+            return
+        q._summary_mean = f['mean'][:]
+        q._summary_median = f['median'][:]
+        q._summary_pct = f['percentile'][:]
+        q._summary_pct_values = f.attrs['pct'][:]
+
+
+def bayestar_map(version, max_samples=5):
+    fname = os.path.join(data_path, version+'.h5')
+    summary_fname = os.path.join(data_path, version+'-summary.h5')
+
+    def summary_signature():
+        if os.path.exists(summary_fname):
+            return map_cache.file_signature(summary_fname)
+        return None
+
+    def load():
+        q = BayestarQuery(map_fname=fname, max_samples=max_samples)
+        if os.path.exists(summary_fname):
+            load_summary(
+                q, summary_fname,
+                map_cache.file_signature(fname),
+                max_samples)
+        return q
+
+    def load_shared():
+        # Back the map's arrays with memory-mapped files, so that all worker
+        # processes on this host share one copy of them
+        source = map_cache.file_signature(fname)
+        summary = summary_signature()
+        return map_cache.cached_object(
+            version,
+            map_cache.cache_key(source, max_samples, summary),
+            load,
+            meta={
+                'source': source,
+                'max_samples': max_samples,
+                'summary': summary})
+
+    return LazyMap(version, load_shared if share_maps else load, fname=fname)
+
+
+def image_builder(lazy_q):
+    """
+    Returns a function that loads the image of the given map from the disk
+    cache (memory-mapped), generating and caching it first if necessary. By
+    default, the image is generated from the currently loaded version of the
+    map, but a different query object can be passed to the function.
+    """
+    def build(q=None):
+        source = map_cache.file_signature(lazy_q.fname)
+        key = map_cache.cache_key(source, image_nside, image_dists, 'mean')
+
+        def gen():
+            print('Generating {} image ...'.format(lazy_q.name))
+            nside, img = gen_images(
+                q if q is not None else lazy_q.get(),
+                image_nside, image_dists,
+                mode='mean')
+            return img
+        img = map_cache.cached_array(
+            lazy_q.name+'-image',
+            key,
+            gen,
+            meta={
+                'source': source,
+                'nside': image_nside,
+                'dists': image_dists})
+        image_signatures[lazy_q.name] = source
+        return image_nside, img
+    return build
+
+
+bayestar2015 = bayestar_map('bayestar2015')
+bayestar2017 = bayestar_map('bayestar2017')
+bayestar2019 = bayestar_map('bayestar2019')
+sfd = LazyMap('sfd', lambda: SFDQuery(map_dir=data_path))
 # planck = PlanckQuery()
 # marshall = MarshallQuery()
-print('Generating map images ...')
-image_data = {
-    'bayestar'+n: gen_images(q, 1024, (0.3, 1., 5.), mode='mean')
-    for n,q in (('2015',bayestar2015),('2017',bayestar2017),('2019',bayestar2019))
-}
-print('Done loading data.')
+
+# Map images (used for postage stamps), at a fixed nside and set of
+# distances (in kpc)
+image_nside = 1024
+image_dists = (0.3, 1., 5.)
+image_signatures = {}   # Signatures of the map files the images came from
+image_data = LazyImageData({
+    q.name: image_builder(q)
+    for q in (bayestar2015, bayestar2017, bayestar2019)
+})
 
 
 #
@@ -83,6 +283,11 @@ bayestar_schema = {
     },
     'return_flags': {
         'type': 'boolean'
+    },
+    'seed': {
+        'type': 'integer',
+        'min': 0,
+        'max': 2**63-1
     }
 }
 
@@ -94,8 +299,11 @@ sfd_schema = {
     }
 }
 
-def bayestar_query_size_calculator(q_obj):
-    def bayestar_query_size(coords, mode='random_sample', pct=None, return_flags=False):
+def bayestar_query_size_calculator(lazy_q):
+    def bayestar_query_size(coords, mode='random_sample', pct=None, return_flags=False,
+                            seed=None):
+        q_obj = lazy_q.get()
+
         # pct, scalar_pct = q_obj._interpret_percentile(mode, pct)
 
         n_coords = coords.size #np.prod(coords.shape, dtype=int)
@@ -120,46 +328,156 @@ def default_query_size(coords, **kwargs):
     return coords.size
 
 
-def get_size_checker(max_size, f_size=default_query_size):
-    def fn(coords, **kwargs):
-        s = f_size(coords, **kwargs)
-        if s > max_size:
-            return False, s, max_size
-        return True, None, None
-    return fn
-
-
 # Dictionary indexing the different maps by name.
-# Each entry must include the query object, and may include a validation schema
-# for the keyword arguments, and a size checker that determines whether or not
-# the requested output is too large.
+# Each entry must include the query object and a function that calculates
+# the size of the requested output (used to estimate the cost of queries; see
+# cost_model.py), and may include a validation schema for the keyword
+# arguments, and a function that queries the map
+# directly from Galactic coordinates stored as plain arrays (a GalCoords
+# object), bypassing SkyCoord.
 handlers = {
-    'bayestar2015': {
-        'q': bayestar2015,
-        'schema': bayestar_schema,
-        'size_checker': get_size_checker(
-            1.e6,
-            f_size=bayestar_query_size_calculator(bayestar2015))
-    },
-    'bayestar2017': {
-        'q': bayestar2017,
-        'schema': bayestar_schema,
-        'size_checker': get_size_checker(
-            1.e6,
-            f_size=bayestar_query_size_calculator(bayestar2017))
-    },
-    'bayestar2019': {
-        'q': bayestar2019,
-        'schema': bayestar_schema,
-        'size_checker': get_size_checker(
-            1.e6,
-            f_size=bayestar_query_size_calculator(bayestar2019))
-    },
-    'sfd': {
-        'q': sfd,
-        'schema': sfd_schema,
-        'size_checker': get_size_checker(1.e6)
-    }
+    'bayestar2015': MapHandler(
+        bayestar2015,
+        query_gal=fastquery.bayestar_query,
+        schema=bayestar_schema,
+        query_size=bayestar_query_size_calculator(bayestar2015)
+    ),
+    'bayestar2017': MapHandler(
+        bayestar2017,
+        query_gal=fastquery.bayestar_query,
+        schema=bayestar_schema,
+        query_size=bayestar_query_size_calculator(bayestar2017)
+    ),
+    'bayestar2019': MapHandler(
+        bayestar2019,
+        query_gal=fastquery.bayestar_query,
+        schema=bayestar_schema,
+        query_size=bayestar_query_size_calculator(bayestar2019)
+    ),
+    'sfd': MapHandler(
+        sfd,
+        query_gal=fastquery.sfd_query,
+        schema=sfd_schema,
+        query_size=default_query_size
+    )
     # 'planck': (mapdata.planck, None),
     # 'marshall': (mapdata.marshall, None)
 }
+
+
+def preload(names):
+    """
+    Loads the given maps (and their images) immediately, rather than on first
+    use. The special name 'all' loads every map.
+    """
+    if 'all' in names:
+        names = list(handlers.keys())
+    for name in names:
+        handlers[name]['q']
+        if name in image_data.available():
+            image_data[name]
+    print('Done loading data.')
+
+
+#
+# Reloading of maps whose files have changed
+#
+
+_reload_lock = threading.Lock()
+_last_reload_check = [0.]
+
+
+def reload_map(name):
+    """
+    Loads a new version of the given map (and its image, if resident), and
+    then swaps it in. The old version is served until the swap, and
+    in-flight requests that hold a reference to it finish on it.
+    """
+    lazy_q = handlers[name].lazy_q
+
+    new_q, signature = None, None
+    if lazy_q.loaded:
+        new_q, signature = lazy_q.load_new()
+
+    new_img = None
+    if dict.__contains__(image_data, name):
+        new_img = image_builder(lazy_q)(q=new_q)
+
+    if new_q is not None:
+        lazy_q.swap(new_q, signature)
+    if new_img is not None:
+        image_data[name] = new_img
+    print('Reloaded {}.'.format(name))
+
+
+def changed_maps():
+    """
+    Returns the names of the resident maps (or map images) whose files have
+    changed since they were loaded.
+    """
+    names = []
+    for name,h in handlers.items():
+        served = []
+        if h.lazy_q.loaded:
+            served.append(h.lazy_q.signature)
+        if dict.__contains__(image_data, name):
+            served.append(image_signatures.get(name))
+        if not served or h.lazy_q.fname is None:
+            continue
+        current = h.lazy_q.file_signature()
+        if any(sig != current for sig in served):
+            names.append(name)
+    return names
+
+
+def _reload_changed():
+    # Only one reload runs at a time, so that at most one extra copy of a
+    # map is held in memory
+    if not _reload_lock.acquire(False):
+        return
+    try:
+        for name in changed_maps():
+            try:
+                reload_map(name)
+            except Exception as err:
+                print('Failed to reload {}: {}'.format(name, err))
+    finally:
+        _reload_lock.release()
+
+
+def check_for_updates():
+    """
+    Reloads (in a background thread) any resident maps whose files have
+    changed. Checks at most once every ``reload_check_interval`` seconds.
+    New map files should be moved into place atomically (e.g., with ``mv``).
+    Touching a map file forces it to be reloaded.
+    """
+    if reload_check_interval <= 0:
+        return
+    t = time.time()
+    if t - _last_reload_check[0] < reload_check_interval:
+        return
+    _last_reload_check[0] = t
+    thread = threading.Thread(target=_reload_changed)
+    thread.daemon = True
+    thread.start()
+
+
+def status():
+    """
+    Returns a dictionary describing which maps (and map images) are resident
+    in this process.
+    """
+    return {
+        name: {
+            'loaded': h.lazy_q.loaded,
+            'load_time': h.lazy_q.load_time,
+            'summary_loaded': hasattr(h.lazy_q._obj, '_summary_mean'),
+            'image_loaded': dict.__contains__(image_data, name)
+        }
+        for name,h in handlers.items()
+    }
+
+
+if preload_maps:
+    preload(preload_maps)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  multiquery.py
+#  Queries of several maps at the same coordinates.
+#
+#  The coordinates are converted to Galactic once, and the HEALPix pixel
+#  indices of the coordinates at each nside are computed once and shared by
+#  all the Bayestar maps. The maps are queried concurrently in the shared
+#  pool of threads (see parallel.py).
+#
+
+from __future__ import print_function, division
+
+from dustmaps.bayestar import BayestarQuery
+
+from config import multi_query_threads
+
+import parallel
+import pixquery
+
+
+def query_maps(handlers, names, coords, kwargs):
+    """
+    Queries each of the named maps (which must all have a 'query_gal'
+    function) at the given coordinates (a GalCoords object). ``kwargs`` is a
+    dictionary of keyword arguments for each map. Returns a dictionary of
+    results, keyed by map name.
+    """
+    query_objs = [handlers[name]['q'] for name in names]
+
+    # Compute the pixel indices of the coordinates at each nside used by
+    # any of the Bayestar maps
+    l, b, d = coords.flat()
+    nsides = set()
+    for q in query_objs:
+        if isinstance(q, BayestarQuery):
+            nsides.update(int(n) for n in q._nside_levels)
+    nsides = sorted(nsides)
+    ipix = parallel.map_threads(
+        lambda n: pixquery.lb2pix(n, l, b, nest=True),
+        nsides, multi_query_threads)
+    ipix_cache = dict(zip(nsides, ipix))
+
+    def query(k):
+        name = names[k]
+        return handlers[name]['query_gal'](
+            query_objs[k], coords,
+            ipix_cache=ipix_cache,
+            **kwargs.get(name, {}))
+
+    res = parallel.map_threads(query, range(len(names)), multi_query_threads)
+    return dict(zip(names, res))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  parallel.py
+#  Parallel execution of map queries in a pool of threads.
+#
+#  Large queries are split into chunks of coordinates, which are queried
+#  concurrently, and the results are then concatenated. Threads (rather than
+#  processes) are used, because most of the work is done in numpy, which
+#  releases the GIL, and because the threads share the loaded maps. The pool
+#  is created on first use in each process, so that it is never inherited
+#  across a fork.
+#
+#  Large queries are also sorted spatially (by nested HEALPix index) before
+#  they are queried, so that the map data is read in order, rather than
+#  scattered across the (possibly memory-mapped) arrays. The results are
+#  returned in the original order.
+#
+
+from __future__ import print_function, division
+
+from multiprocessing.pool import ThreadPool
+import threading
+
+import numpy as np
+
+from config import (query_threads, query_chunk_min_coords,
+                    multi_query_threads, sort_min_coords)
+
+import fastquery
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the thread pool, creating it on first use.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPool(max(query_threads, multi_query_threads))
+    return _pool
+
+
+def reset():
+    """
+    Forgets the thread pool (e.g., one inherited from a parent process,
+    whose threads do not exist in this process).
+    """
+    global _pool
+    _pool = None
+
+
+def map_threads(f, args, n_threads):
+    """
+    Returns ``[f(a) for a in args]``, computed using at most ``n_threads``
+    threads at a time.
+    """
+    args = list(args)
+    n_threads = min(n_threads, len(args))
+    if n_threads <= 1:
+        return [f(a) for a in args]
+
+    # Each thread processes every n_threads-th argument
+    groups = [args[k::n_threads] for k in range(n_threads)]
+    res = get_pool().map(lambda grp: [f(a) for a in grp], groups)
+
+    out = [None] * len(args)
+    for k,r in enumerate(res):
+        out[k::n_threads] = r
+    return out
+
+
+def chunkable(kwargs):
+    """
+    Returns ``True`` if a query with the given keyword arguments gives the
+    same results when the coordinates are queried in separate chunks. In
+    unseeded "random_sample_per_pix" mode, all coordinates have to be queried
+    together, so that those in the same pixel get the same sample.
+    """
+    return not ((kwargs.get('mode') == 'random_sample_per_pix') and
+                (kwargs.get('seed') is None))
+
+
+def _concatenate(res):
+    # Concatenates the results of queries of consecutive chunks of flattened
+    # coordinates. The results take the dtype of the first chunk, as they
+    # would if all the coordinates were queried at once.
+    if isinstance(res[0], (list, tuple)):
+        return type(res[0])(
+            _concatenate([r[k] for r in res])
+            for k in range(len(res[0])))
+    res = [np.asarray(r) for r in res]
+    return np.concatenate(res).astype(res[0].dtype, copy=False)
+
+
+def unsort(res, order):
+    """
+    Restores the original order of the results of a query of (flattened)
+    coordinates that were taken in the given order.
+    """
+    if isinstance(res, (list, tuple)):
+        return type(res)(unsort(r, order) for r in res)
+    res = np.asarray(res)
+    out = np.empty_like(res)
+    out[order] = res
+    return out
+
+
+def query_gal(handler, coords, q=None, **kwargs):
+    """
+    Queries a map (with a 'query_gal' function) at the given coordinates (a
+    GalCoords object), using the query object ``q`` (by default, the
+    handler's current one). Queries of at least ``sort_min_coords``
+    coordinates are sorted spatially. Queries of at least twice
+    ``query_chunk_min_coords`` coordinates are split into chunks, which are
+    queried using up to ``query_threads`` threads.
+    """
+    if q is None:
+        q = handler['q']
+
+    n_chunks = min(query_threads, coords.size // max(1, query_chunk_min_coords))
+    if not chunkable(kwargs):
+        n_chunks = 1
+    sort = (sort_min_coords > 0) and (coords.size >= sort_min_coords)
+    if (n_chunks <= 1) and not sort:
+        return handler['query_gal'](q, coords, **kwargs)
+
+    order = None
+    if sort:
+        order = fastquery.spatial_order(coords)
+        coords_q = coords.take(order)
+    else:
+        coords_q = coords
+
+    if n_chunks <= 1:
+        res = handler['query_gal'](q, coords_q, **kwargs)
+    else:
+        chunk_size = -(-coords.size // n_chunks)
+        res = _concatenate(map_threads(
+            lambda c: handler['query_gal'](q, c, **kwargs),
+            coords_q.chunks(chunk_size),
+            n_chunks))
+
+    if order is not None:
+        res = unsort(res, order)
+
+    return fastquery.reshape_output(res, coords)
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  pixquery.py
+#  Queries of the Bayestar maps at precomputed pixel indices.
+#
+#  Mirrors BayestarQuery.query (from dustmaps), but splits each query into
+#  two steps: resolving the coordinates to map pixels, and gathering the
+#  requested values from those pixels. This allows one pixel lookup to be
+#  reused for several gathers (e.g., at different distances).
+#
+
+from __future__ import print_function, division
+
+import numpy as np
+
+from dustmaps.bayestar import lb2pix
+
+
+def find_pix_idx(q, l, b, ipix_cache=None):
+    """
+    Returns the index of the map pixel (in the pixel_info, samples and
+    best_fit arrays of the query object ``q``) containing each of the given
+    Galactic coordinates (in degrees). Coordinates outside of the map
+    footprint are assigned the index -1.
+
+    If a dictionary ``ipix_cache`` is given, the HEALPix pixel indices of the
+    coordinates at each nside are stored in it (and reused from it), so that
+    several maps can be queried at the same coordinates without recomputing
+    them.
+    """
+    if ipix_cache is None:
+        return q._find_data_idx(l, b)
+
+    # Same as BayestarQuery._find_data_idx, but with cached pixel indices
+    pix_idx = np.full(l.shape, -1, dtype='i8')
+
+    for k,nside in enumerate(q._nside_levels):
+        if nside not in ipix_cache:
+            ipix_cache[nside] = lb2pix(nside, l, b, nest=True)
+        ipix = ipix_cache[nside]
+
+        # Find the query pixels in the ordered list of map pixels
+        hp_idx_sorted = q._hp_idx_sorted[k]
+        idx = np.searchsorted(hp_idx_sorted, ipix, side='left')
+        in_bounds = (idx < hp_idx_sorted.size)
+        if not np.any(in_bounds):
+            continue
+
+        idx[~in_bounds] = -1
+        match_idx = (hp_idx_sorted[idx] == ipix)
+        match_idx[~in_bounds] = False
+
+        if np.any(match_idx):
+            pix_idx[match_idx] = q._data_idx[k][idx[match_idx]]
+
+    return pix_idx
+
+
+def _mix(x):
+    # The finalizer of the SplitMix64 generator: a bijective scrambling of
+    # 64-bit integers
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def seeded_sample_idx(seed, n_samples, pix_idx, d=None):
+    """
+    Returns the index of the sample to use for each pixel (and, optionally,
+    distance) in a query. The sample is a deterministic (pseudorandom)
+    function of the seed, the pixel index and the distance.
+    """
+    with np.errstate(over='ignore'):
+        h = _mix(np.uint64(seed) + np.uint64(0x9e3779b97f4a7c15))
+        h = _mix(h ^ pix_idx.astype('i8').view('u8'))
+        if d is not None:
+            h = _mix(h ^ np.asarray(d, dtype='f8').view('u8'))
+    return (h % np.uint64(n_samples)).astype('i8')
+
+
+def query_pix(q, pix_idx, d=None, mode='random_sample', pct=None,
+              return_flags=False, seed=None):
+    """
+    Queries the Bayestar map ``q`` in the given pixels (as returned by
+    ``find_pix_idx``). The arguments and output are the same as for
+    BayestarQuery.query, except that the coordinates are replaced by a flat
+    array of pixel indices, and (optionally) a flat array of distances, in
+    kpc.
+
+    If a ``seed`` is given, the samples chosen in the modes 'random_sample'
+    and 'random_sample_per_pix' are a deterministic function of the seed and
+    the pixel (and, in 'random_sample' mode, the distance), so that repeated
+    queries return the same results.
+    """
+    # Check that the query mode is supported
+    q._raise_on_mode(mode)
+
+    # Validate percentile specification
+    pct, scalar_pct = q._interpret_percentile(mode, pct)
+
+    n_coords_ret = pix_idx.shape[0]
+    has_dist = (d is not None)
+    in_bounds_idx = (pix_idx != -1)
+
+    # Extract the correct samples
+    if mode == 'random_sample':
+        # A different sample in each queried coordinate
+        if seed is None:
+            samp_idx = np.random.randint(0, q._n_samples, pix_idx.size)
+        else:
+            samp_idx = seeded_sample_idx(seed, q._n_samples, pix_idx, d=d)
+        n_samp_ret = 1
+    elif mode == 'random_sample_per_pix':
+        # Choose same sample in all coordinates that fall in same angular
+        # HEALPix pixel
+        if seed is None:
+            samp_idx = np.random.randint(0, q._n_samples, q._n_pix)[pix_idx]
+        else:
+            samp_idx = seeded_sample_idx(seed, q._n_samples, pix_idx)
+        n_samp_ret = 1
+    elif mode == 'best':
+        samp_idx = slice(None)
+        n_samp_ret = 1
+    else:
+        # Return all samples in each queried coordinate
+        samp_idx = slice(None)
+        n_samp_ret = q._n_samples
+
+    if mode == 'best':
+        val = q._best_fit
+    else:
+        val = q._samples
+
+    # Create empty array to store flags
+    if return_flags:
+        if has_dist:
+            dtype = [('converged', 'bool'),
+                     ('reliable_dist', 'bool')]
+        else:
+            dtype = [('converged', 'bool'),
+                     ('min_reliable_distmod', 'f4'),
+                     ('max_reliable_distmod', 'f4')]
+        flags = np.empty(n_coords_ret, dtype=dtype)
+
+    if has_dist:
+        # Determine ceiling bin index for each coordinate
+        dm = 5. * (np.log10(d) + 2.)
+        bin_idx_ceil = np.searchsorted(q._DM_bin_edges, dm)
+
+        # Create NaN-filled return arrays
+        if isinstance(samp_idx, slice):
+            ret = np.full((n_coords_ret, n_samp_ret), np.nan, dtype='f4')
+        else:
+            ret = np.full((n_coords_ret,), np.nan, dtype='f4')
+
+        # d < d(nearest distance slice)
+        idx_near = (bin_idx_ceil == 0) & in_bounds_idx
+        if np.any(idx_near):
+            a = 10.**(0.2 * (dm[idx_near] - q._DM_bin_edges[0]))
+            if isinstance(samp_idx, slice):
+                ret[idx_near] = (
+                    a[:,None]
+                    * val[pix_idx[idx_near], samp_idx, 0])
+            else:
+                ret[idx_near] = (
+                    a * val[pix_idx[idx_near], samp_idx[idx_near], 0])
+
+        # d > d(farthest distance slice)
+        idx_far = (bin_idx_ceil == q._n_distances) & in_bounds_idx
+        if np.any(idx_far):
+            if isinstance(samp_idx, slice):
+                ret[idx_far] = val[pix_idx[idx_far], samp_idx, -1]
+            else:
+                ret[idx_far] = val[pix_idx[idx_far], samp_idx[idx_far], -1]
+
+        # d(nearest distance slice) < d < d(farthest distance slice)
+        idx_btw = ~idx_near & ~idx_far & in_bounds_idx
+        if np.any(idx_btw):
+            DM_ceil = q._DM_bin_edges[bin_idx_ceil[idx_btw]]
+            DM_floor = q._DM_bin_edges[bin_idx_ceil[idx_btw]-1]
+            a = (DM_ceil - dm[idx_btw]) / (DM_ceil - DM_floor)
+            if isinstance(samp_idx, slice):
+                ret[idx_btw] = (
+                    (1.-a[:,None])
+                    * val[pix_idx[idx_btw], samp_idx, bin_idx_ceil[idx_btw]]
+                    + a[:,None]
+                    * val[pix_idx[idx_btw], samp_idx, bin_idx_ceil[idx_btw]-1]
+                )
+            else:
+                ret[idx_btw] = (
+                    (1.-a) * val[pix_idx[idx_btw], samp_idx[idx_btw], bin_idx_ceil[idx_btw]]
+                    +    a * val[pix_idx[idx_btw], samp_idx[idx_btw], bin_idx_ceil[idx_btw]-1]
+                )
+
+        # Flag: distance in reliable range?
+        if return_flags:
+            dm_min = q._pixel_info['DM_reliable_min'][pix_idx]
+            dm_max = q._pixel_info['DM_reliable_max'][pix_idx]
+            flags['reliable_dist'] = (
+                (dm >= dm_min) &
+                (dm <= dm_max) &
+                np.isfinite(dm_min) &
+                np.isfinite(dm_max))
+            flags['reliable_dist'][~in_bounds_idx] = False
+    else:   # No distances provided
+        ret = val[pix_idx, samp_idx, :]   # Return all distances
+        ret[~in_bounds_idx] = np.nan
+
+        # Flag: reliable distance bounds
+        if return_flags:
+            dm_min = q._pixel_info['DM_reliable_min'][pix_idx]
+            dm_max = q._pixel_info['DM_reliable_max'][pix_idx]
+
+            flags['min_reliable_distmod'] = dm_min
+            flags['max_reliable_distmod'] = dm_max
+            flags['min_reliable_distmod'][~in_bounds_idx] = np.nan
+            flags['max_reliable_distmod'][~in_bounds_idx] = np.nan
+
+    # Flag: convergence
+    if return_flags:
+        flags['converged'] = (
+            q._pixel_info['converged'][pix_idx].astype(bool))
+        flags['converged'][~in_bounds_idx] = False
+
+    # Reduce the samples in the requested manner
+    if mode == 'median':
+        ret = np.median(ret, axis=1)
+    elif mode == 'mean':
+        ret = np.mean(ret, axis=1)
+    elif mode == 'percentile':
+        ret = np.nanpercentile(ret, pct, axis=1)
+        if not scalar_pct:
+            # (percentile, pixel) -> (pixel, percentile)
+            # (pctile, pixel, distance) -> (pixel, distance, pctile)
+            ret = np.moveaxis(ret, 0, -1)
+    elif mode == 'best':
+        # Remove "samples" axis
+        s = ret.shape
+        ret.shape = s[:1] + s[2:]
+
+    if return_flags:
+        return ret, flags
+
+    return ret
+
+
+def query_pix_dists(q, pix_idx, dists, **kwargs):
+    """
+    Queries the Bayestar map ``q`` in the given pixels, at each of several
+    distances (in kpc), reusing the pixel lookup. Returns a list containing
+    the output of ``query_pix`` at each distance.
+    """
+    return [query_pix(q, pix_idx, d=np.full(pix_idx.shape, d), **kwargs)
+            for d in dists]
+
+
+def query_pix_samples_best(q, pix_idx, d=None):
+    """
+    Queries the samples and the best fit of the Bayestar map ``q`` in the
+    given pixels, reusing the pixel lookup. Returns (samples, best, flags),
+    where samples and flags are the output of BayestarQuery.query in
+    'samples' mode (with ``return_flags=True``), and best is the output in
+    'best' mode.
+    """
+    samples, flags = query_pix(q, pix_idx, d=d, mode='samples',
+                               return_flags=True)
+    best = query_pix(q, pix_idx, d=d, mode='best')
+    return samples, best, flags
+
+
+def unique_pix(pix_idx, d=None):
+    """
+    Finds the unique pixels (or, if distances are given, the unique
+    pixel-distance pairs) in a query. Returns the indices of the first query
+    coordinate in each unique group, and the index of the group that each
+    coordinate belongs to.
+    """
+    if d is None:
+        order = np.argsort(pix_idx, kind='mergesort')
+    else:
+        order = np.lexsort((d, pix_idx))
+
+    pix_sorted = pix_idx[order]
+    first = np.empty(pix_sorted.size, dtype=bool)
+    first[:1] = True
+    first[1:] = (pix_sorted[1:] != pix_sorted[:-1])
+    if d is not None:
+        d_sorted = d[order]
+        first[1:] |= (d_sorted[1:] != d_sorted[:-1])
+
+    inverse = np.empty(pix_idx.size, dtype='i8')
+    inverse[order] = np.cumsum(first) - 1
+
+    return order[first], inverse
+
+
+# Queries with fewer coordinates than this are not deduplicated
+dedup_min_coords = 1000
+
+# Only deduplicate if the fraction of unique pixels is at most this
+dedup_max_unique_frac = 0.5
+
+
+def query_pix_unique(q, pix_idx, d=None, mode='random_sample', **kwargs):
+    """
+    Like ``query_pix``, but queries each unique pixel (or pixel-distance
+    pair) only once, and then scatters the results back to the original
+    coordinates. This is much faster for catalogs with many coordinates in
+    the same pixel. Results are identical to those of ``query_pix``.
+
+    In unseeded 'random_sample' mode, each coordinate gets an independent
+    sample, so no deduplication is done.
+    """
+    unseeded = (kwargs.get('seed') is None)
+    if (mode == 'random_sample' and unseeded) or (pix_idx.size < dedup_min_coords):
+        return query_pix(q, pix_idx, d=d, mode=mode, **kwargs)
+
+    idx, inverse = unique_pix(pix_idx, d=d)
+    if idx.size > dedup_max_unique_frac * pix_idx.size:
+        return query_pix(q, pix_idx, d=d, mode=mode, **kwargs)
+
+    # Put the group of the first coordinate first. Some numpy reductions
+    # (e.g., nanpercentile) choose the output dtype based on the first row,
+    # so this ensures that the output is identical to that of query_pix.
+    g0 = inverse[0]
+    if g0 != 0:
+        idx[[0, g0]] = idx[[g0, 0]]
+        is_0, is_g0 = (inverse == 0), (inverse == g0)
+        inverse[is_0] = g0
+        inverse[is_g0] = 0
+
+    out = query_pix(
+        q, pix_idx[idx],
+        d=None if d is None else d[idx],
+        mode=mode,
+        **kwargs)
+
+    if isinstance(out, tuple):
+        return tuple(o[inverse] for o in out)
+    return out[inverse]
+
+
+class _SummaryView(object):
+    # Presents a query object with some of its arrays replaced (e.g., with
+    # precomputed summary statistics in place of the samples), so that
+    # query_pix can gather from them.
+    def __init__(self, q, **attrs):
+        self._q = q
+        self.__dict__.update(attrs)
+
+    def __getattr__(self, name):
+        return getattr(self._q, name)
+
+
+def query_pix_summary(q, pix_idx, d=None, mode='random_sample', pct=None,
+                      return_flags=False, seed=None):
+    """
+    Answers a query (with the same arguments as ``query_pix``) from the
+    precomputed summary statistics of the map's samples (see
+    utils/create_summary_cubes.py), if the map has them and the query can be
+    answered from them. Otherwise, returns ``None``.
+
+    The mean commutes with the linear interpolation between distance bins,
+    so 'mean' queries can be answered at any distance. 'median' and
+    'percentile' queries can only be answered if no distances are given, and
+    (for 'percentile') if all the requested percentiles were precomputed.
+    """
+    if mode == 'mean':
+        cube = getattr(q, '_summary_mean', None)
+    elif (mode == 'median') and (d is None):
+        cube = getattr(q, '_summary_median', None)
+    elif (mode == 'percentile') and (d is None):
+        cube = getattr(q, '_summary_pct', None)
+    else:
+        return None
+
+    if cube is None:
+        return None
+
+    if mode != 'percentile':
+        # The cube has the same shape as the best fit, (pixel, 1, distance)
+        return query_pix(
+            _SummaryView(q, _best_fit=cube),
+            pix_idx, d=d, mode='best',
+            return_flags=return_flags)
+
+    # Find the requested percentiles in the cube
+    pct, scalar_pct = q._interpret_percentile(mode, pct)
+    pct_idx = []
+    for p in np.atleast_1d(pct):
+        k = np.nonzero(q._summary_pct_values == p)[0]
+        if not len(k):
+            return None
+        pct_idx.append(k[0])
+
+    # The cube has the same layout as the samples, (pixel, pctile, distance)
+    out = query_pix(
+        _SummaryView(q, _samples=cube, _n_samples=cube.shape[1]),
+        pix_idx, mode='samples',
+        return_flags=return_flags)
+    ret = out[0] if return_flags else out
+
+    if scalar_pct:
+        ret = ret[:, pct_idx[0], :]
+    else:
+        # (pixel, pctile, distance) -> (pixel, distance, pctile)
+        ret = np.moveaxis(ret[:, pct_idx, :], 1, -1)
+
+    if return_flags:
+        return ret, out[1]
+    return ret
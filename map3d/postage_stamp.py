@@ -24,7 +24,7 @@ media_path = os.path.join(script_dir, 'static', 'media')
 img_shape = (500, 500)
 radius = 1.5*7.5
 rasterizer = proj_fast.MapRasterizerFast(
-    mapdata.image_data['bayestar2015'][0],
+    mapdata.image_nside,
     img_shape,
     fov=2*radius)
 
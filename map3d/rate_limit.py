@@ -7,42 +7,368 @@
 #  Adapted by Gregory Green from http://flask.pocoo.org/snippets/70/
 #  Originally by Armin Ronacher
 #
+#  The limits are enforced with token buckets stored in Redis, which are
+#  updated by a server-side (Lua) script, so that each check is a single
+#  atomic round trip. Optionally, each worker process checks most requests
+#  against local copies of the buckets, and synchronizes them with Redis
+#  periodically (see LocalBuckets).
+#
+
+from __future__ import print_function, division
 
 from map3d import app, redis
 
+import math
 import time
+import atexit
+import threading
 
 from flask import request, g
 import functools
 
+from config import rate_limit_sync_interval, rate_limit_local_share
 
-class RateLimit(object):
-    expiration_window = 10
 
-    def __init__(self, key_prefix, limit, per, send_x_headers):
-        # Calculate the next multiple of <per> above current time
-        self.reset = (int(time.time()) // per) * per + per
+# Token buckets, updated atomically in one call. For each bucket (KEYS[i]),
+# ARGV holds its capacity, refill rate (per second) and the number of tokens
+# to take, and the last two arguments are a flag that forces the tokens to be
+# taken (even if the buckets run into debt), and the current time (in
+# seconds). Otherwise, tokens are taken from all the buckets, or (if any of
+# them has too few) from none. Returns whether the tokens were taken,
+# followed by the number of tokens left in each bucket, and the time (in
+# seconds) until it is full again.
+token_bucket_script = """
+local force = tonumber(ARGV[#ARGV-1])
+local now = tonumber(ARGV[#ARGV])
+local tokens = {}
+local allowed = 1
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[3*i-2])
+    local rate = tonumber(ARGV[3*i-1])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local t = tonumber(state[1])
+    local ts = tonumber(state[2])
+    if t == nil then
+        t = capacity
+        ts = now
+    end
+    t = math.min(capacity, t + math.max(0, now - ts) * rate)
+    if (force == 0) and (t < tonumber(ARGV[3*i])) then
+        allowed = 0
+    end
+    tokens[i] = t
+end
+local res = {allowed}
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[3*i-2])
+    local rate = tonumber(ARGV[3*i-1])
+    if allowed == 1 then
+        tokens[i] = tokens[i] - tonumber(ARGV[3*i])
+    end
+    local t_full = (capacity - tokens[i]) / rate
+    redis.call('HMSET', KEYS[i], 'tokens', tostring(tokens[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[i], math.ceil(t_full) + 1)
+    res[#res+1] = tostring(tokens[i])
+    res[#res+1] = tostring(t_full)
+end
+return res
+"""
+
+token_bucket = redis.register_script(token_bucket_script)
+
+
+def _parse_buckets(res):
+    # Parses the reply of the token-bucket script
+    return bool(res[0]), [
+        (float(res[k]), float(res[k+1]))
+        for k in range(1, len(res), 2)]
+
+
+def take_tokens(buckets, client, force=False):
+    """
+    Takes tokens from the given buckets, each given by (key, capacity, rate,
+    number of tokens), in one call to Redis. Returns whether the tokens were
+    taken, and the number of tokens left in each bucket and the time until it
+    is full.
+    """
+    args = []
+    for key, capacity, rate, n in buckets:
+        args += [capacity, rate, n]
+    args += [int(force), repr(time.time())]
+    return _parse_buckets(token_bucket(
+        keys=[b[0] for b in buckets],
+        args=args,
+        client=client))
+
+
+class _LocalBucket(object):
+    # The state of a bucket at its last synchronization with Redis, and the
+    # number of tokens taken locally since then
+
+    def __init__(self, client, capacity, rate):
+        self.client = client
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.synced_at = 0.
+        self.pending = 0
+
+    def available(self, t):
+        # Tokens in the bucket at time t, not counting local takes
+        return min(self.capacity,
+                   self.tokens + max(0., t - self.synced_at) * self.rate)
+
+    def sync(self, tokens, t):
+        self.tokens = tokens
+        self.synced_at = t
+
+
+class LocalBuckets(object):
+    """
+    Approximate token buckets, kept in each worker process. Tokens are taken
+    from local copies of the buckets, without contacting Redis, as long as
+    each copy was synchronized less than ``sync_interval`` seconds ago, and
+    the tokens taken locally since then are no more than ``share`` of those
+    that were left. Otherwise (e.g., near the limit), the tokens are taken
+    in Redis, as in the exact mode. The tokens taken locally are sent to
+    Redis in batches, at least every ``sync_interval`` seconds, by a
+    background thread (so that they are also sent if the process goes idle),
+    and when the process exits.
+    """
+
+    def __init__(self, sync_interval, share):
+        self.sync_interval = sync_interval
+        self.share = share
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all local state (e.g., that inherited from a parent process,
+        whose local takes are sent to Redis by the parent).
+        """
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._flusher = None
+
+    def _start_flusher(self):
+        # Starts the background thread that flushes the local takes (in each
+        # process, as threads are not inherited by forked processes)
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_periodically)
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.flush()
+            except Exception as err:
+                print('Failed to flush rate-limit tokens: {}'.format(err))
+
+    def take(self, buckets, client):
+        """
+        Takes tokens from the given buckets, in the same way as
+        ``take_tokens``.
+        """
+        if self._flusher is None:
+            self._start_flusher()
+
+        t = time.time()
+
+        with self._lock:
+            local = []
+            for key, capacity, rate, n in buckets:
+                b = self._buckets.get(key)
+                if (b is None) or (b.client is not client):
+                    b = self._buckets[key] = _LocalBucket(client, capacity, rate)
+                local.append(b)
+
+            if all((t - b.synced_at < self.sync_interval) and
+                   (b.pending + n <= self.share * b.available(t))
+                   for b, (key, capacity, rate, n) in zip(local, buckets)):
+                state = []
+                for b, (key, capacity, rate, n) in zip(local, buckets):
+                    b.pending += n
+                    tokens = b.available(t) - b.pending
+                    state.append((tokens, (capacity - tokens) / rate))
+                res = (True, state)
+            else:
+                res = None
+
+        if res is None:
+            res = self._take_exact(buckets, local, client)
+
+        if t - self._last_flush >= self.sync_interval:
+            self.flush()
 
-        # Set key to combination of the prefix and the reset time
-        self.key = key_prefix + str(self.reset)
+        return res
+
+    def _take_exact(self, buckets, local, client):
+        # Sends the tokens taken locally from the given buckets, and then
+        # takes the requested tokens, in one round trip
+        with self._lock:
+            pending = [b.pending for b in local]
+            for b in local:
+                b.pending = 0
+
+        t = time.time()
+        p = client.pipeline(transaction=False)
+        for (key, capacity, rate, n), n_pending in zip(buckets, pending):
+            if n_pending:
+                token_bucket(
+                    keys=[key],
+                    args=[capacity, rate, n_pending, 1, repr(t)],
+                    client=p)
+        token_bucket(
+            keys=[b[0] for b in buckets],
+            args=sum([[c, r, n] for k, c, r, n in buckets], []) + [0, repr(t)],
+            client=p)
+        allowed, state = _parse_buckets(p.execute()[-1])
+
+        with self._lock:
+            for b, (tokens, t_full) in zip(local, state):
+                b.sync(tokens, t)
+
+        return allowed, state
+
+    def flush(self):
+        """
+        Sends the tokens taken locally to Redis, in one batch per client.
+        """
+        t = time.time()
+        with self._lock:
+            self._last_flush = t
+            batches = {}
+            for key, b in list(self._buckets.items()):
+                if b.pending:
+                    batches.setdefault(id(b.client), []).append(
+                        (key, b, b.pending))
+                    b.pending = 0
+                elif t - b.synced_at >= self.sync_interval:
+                    # Forget buckets that are no longer in use
+                    del self._buckets[key]
+
+        for batch in batches.values():
+            p = batch[0][1].client.pipeline(transaction=False)
+            for key, b, n_pending in batch:
+                token_bucket(
+                    keys=[key],
+                    args=[b.capacity, b.rate, n_pending, 1, repr(t)],
+                    client=p)
+            res = p.execute()
+
+            with self._lock:
+                for (key, b, n_pending), r in zip(batch, res):
+                    b.sync(_parse_buckets(r)[1][0][0], t)
+
+
+def _flush_at_exit():
+    if local_buckets is None:
+        return
+    try:
+        local_buckets.flush()
+    except Exception as err:
+        print('Failed to flush rate-limit tokens: {}'.format(err))
+
+
+local_buckets = None
+if rate_limit_sync_interval > 0:
+    local_buckets = LocalBuckets(
+        rate_limit_sync_interval,
+        rate_limit_local_share)
+    atexit.register(_flush_at_exit)
+
+
+class RateLimit(object):
+    """
+    Limits the rate of requests (and, optionally, their total cost), using
+    token buckets, which hold up to <limit> requests (or <cost_limit>), and
+    are refilled continuously, at <limit> requests per <per> seconds. Each
+    request is checked with a single atomic script call.
+    """
+
+    def __init__(self, key_prefix, limit, per, send_x_headers,
+                 cost_limit=None, client=None):
+        self.key = key_prefix + 'requests'
+        self.cost_key = key_prefix + 'cost'
 
         # <limit> requests are allowed per <per> seconds
         self.limit = limit
         self.per = per
 
+        # Queries with a total cost of <cost_limit> are allowed per <per>
+        # seconds (if not None). The cost of each query is charged by the
+        # view, once it is known.
+        self.cost_limit = None if cost_limit is None else int(cost_limit)
+        self.cost = 0
+
         # If true, send header information back to IP after each request
         # detailing usage and rate-limit info
         self.send_x_headers = send_x_headers
 
-        # Set the key (in the Redis store) with an expiration time
-        p = redis.pipeline()
-        p.incr(self.key)
-        p.expireat(self.key, self.reset + self.expiration_window)
+        # The Redis client (by default, the app's)
+        self.client = redis if client is None else client
+
+        # Take one request from the bucket (and check the cost budget)
+        buckets = [(self.key, limit, 1)]
+        if self.cost_limit is not None:
+            buckets.append((self.cost_key, self.cost_limit, 0))
+        allowed, state = self._take(buckets)
+
+        self.allowed = allowed
+        self.remaining, t_full = state[0]
+        self.reset = int(time.time() + t_full + 0.999)
+
+        # Time (in seconds) until the bucket holds another request, which is
+        # longer if it has run into debt
+        self.retry_after = max(0., t_full - (limit - 1) * per / limit)
 
-        self.current = min(p.execute()[0], limit)
+        self.cost_remaining = None
+        if self.cost_limit is not None:
+            self.cost_remaining, t_full_cost = state[1]
+            # Time until the cost budget is no longer exhausted
+            self.retry_after = max(self.retry_after, t_full_cost - per)
 
-    remaining = property(lambda x: x.limit - x.current)
-    over_limit = property(lambda x: x.current >= x.limit)
+    def _take(self, buckets):
+        # Takes tokens from the given buckets (key, capacity, tokens). Returns
+        # whether the tokens were taken, and the number of tokens left (rounded
+        # down) and time until full of each bucket.
+        buckets = [
+            (key, capacity, capacity / self.per, n)
+            for key, capacity, n in buckets]
+        if local_buckets is not None:
+            allowed, state = local_buckets.take(buckets, self.client)
+        else:
+            allowed, state = take_tokens(buckets, self.client)
+        return allowed, [(int(tokens), t_full) for tokens, t_full in state]
+
+    def charge(self, cost):
+        """
+        Charges the given cost to the budget. Returns ``False`` (and charges
+        nothing) if the cost exceeds the remaining budget.
+        """
+        if self.cost_limit is None:
+            return True
+
+        cost = int(cost)
+        allowed, state = self._take([(self.cost_key, self.cost_limit, cost)])
+        self.cost_remaining, t_full = state[0]
+        if allowed:
+            self.cost = cost
+        else:
+            # Time until the budget holds the cost (or is full, if the cost
+            # is larger than the budget)
+            t_cost = (cost - self.cost_remaining) * self.per / self.cost_limit
+            self.retry_after = max(self.retry_after, min(t_cost, t_full))
+        return allowed
+
+    over_limit = property(lambda x: (not x.allowed) or
+                                    ((x.cost_limit is not None) and
+                                     (x.cost_remaining <= 0)))
 
 
 def get_view_rate_limit():
@@ -51,10 +377,32 @@ def get_view_rate_limit():
 def on_over_limit(rlimit):
     return 'You have hit the rate limit for this resource.', 429
 
+def on_over_cost_limit(rlimit, cost):
+    msg = ('The cost of this query ({:d}) exceeds the remaining budget for '
+           'this resource ({:d} of {:d}, refilled at {:d} per {:d} s). The '
+           'cost of a query is the number of elements in its output '
+           '(coordinates x samples x distances).')
+    msg = msg.format(
+        int(cost), rlimit.cost_remaining, rlimit.cost_limit,
+        rlimit.cost_limit, rlimit.per)
+    return msg, 429
+
+def charge_cost(cost, over_limit=on_over_cost_limit):
+    """
+    Charges the cost of a query to the budget of the current view (if it has
+    one). Returns ``None`` if the query is within the budget, or the response
+    of ``over_limit`` if it is not.
+    """
+    rlimit = get_view_rate_limit()
+    if (rlimit is None) or rlimit.charge(cost):
+        return None
+    return over_limit(rlimit, cost)
+
 def ratelimit(limit, per=300, send_x_headers=False,
               over_limit=on_over_limit,
               scope_func=lambda: request.remote_addr,
-              key_func=lambda: request.endpoint):
+              key_func=lambda: request.endpoint,
+              cost_limit=None, client=None):
 
     def decorator(f):
         @functools.wraps(f)
@@ -63,7 +411,8 @@ def ratelimit(limit, per=300, send_x_headers=False,
             key_prefix = 'rate-limit/%s/%s/' % (key_func(), scope_func())
 
             # Construct the rate limiter, and save it to flask.g
-            rlimit = RateLimit(key_prefix, limit, per, send_x_headers)
+            rlimit = RateLimit(key_prefix, limit, per, send_x_headers,
+                               cost_limit=cost_limit, client=client)
             g._view_rate_limit = rlimit
 
             # Return a standard response if the IP has reached their limit
@@ -81,10 +430,22 @@ def ratelimit(limit, per=300, send_x_headers=False,
 def inject_x_rate_headers(response):
     limit = get_view_rate_limit()
 
+    # The buckets can run into debt (see LocalBuckets), in which case the
+    # remaining requests and cost are reported as zero, and the debt is
+    # reflected in the reset time, and the time after which to retry
     if limit and limit.send_x_headers:
         h = response.headers
-        h.add('X-RateLimit-Remaining', str(limit.remaining))
+        h.add('X-RateLimit-Remaining', str(max(0, limit.remaining)))
         h.add('X-RateLimit-Limit', str(limit.limit))
         h.add('X-RateLimit-Reset', str(limit.reset))
+        if limit.cost_limit is not None:
+            h.add('X-RateLimit-Cost', str(limit.cost))
+            h.add('X-RateLimit-Cost-Remaining',
+                  str(max(0, limit.cost_remaining)))
+            h.add('X-RateLimit-Cost-Limit', str(limit.cost_limit))
+
+    if limit and (response.status_code == 429):
+        response.headers['Retry-After'] = str(
+            max(1, int(math.ceil(limit.retry_after))))
 
     return response
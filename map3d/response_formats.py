@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  response_formats.py
+#  Binary encodings of query results, selected by the Accept header, or
+#  explicitly, by the "format" query parameter (e.g., ?format=npy).
+#
+#  JSON (the default) is encoded by the app's JSON encoder. The binary
+#  formats avoid the cost of encoding (and decoding) large arrays as text:
+#
+#    npy      application/x-npy                    NumPy .npy file
+#    arrow    application/vnd.apache.arrow.stream  Arrow IPC stream (needs
+#                                                  pyarrow)
+#    msgpack  application/x-msgpack                msgpack (needs msgpack)
+#
+#  If the Accept header matches none of the available formats, JSON is
+#  returned. Only an explicitly requested format that is not available is
+#  rejected (with 406).
+#
+#  In each format, the results and flags (if requested) are returned with
+#  their dtypes and shapes, so that they can be decoded without copying.
+#
+#  The .npy and Arrow formats can also be streamed: the results are encoded
+#  and sent one chunk of coordinates at a time, producing the same output as
+#  if the whole query had been encoded at once.
+#
+
+from __future__ import print_function, division
+
+from flask import request, jsonify, Response, stream_with_context
+
+import numpy as np
+import json
+
+from cStringIO import StringIO as IO
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def split_result(res):
+    """
+    Splits the output of a map query into an array of results and an array
+    of flags (``None`` if flags were not requested).
+    """
+    if isinstance(res, (list, tuple)) and (len(res) == 2):
+        flags = np.asarray(res[1])
+        if flags.dtype.names is not None:
+            return np.asarray(res[0]), flags
+    return np.asarray(res), None
+
+
+def npy_array(res, n_coord_dims):
+    """
+    Combines the results and flags of a query into the array stored in .npy
+    files: the results alone, or (if there are flags) a structured array,
+    with the results in the field 'result', and one field per flag. The
+    first ``n_coord_dims`` axes of the results correspond to coordinates.
+    """
+    res, flags = split_result(res)
+    if flags is None:
+        return res
+
+    dtype = [('result', res.dtype, res.shape[n_coord_dims:])]
+    dtype += [(k, flags.dtype[k]) for k in flags.dtype.names]
+    arr = np.empty(flags.shape, dtype=dtype)
+    arr['result'] = res
+    for k in flags.dtype.names:
+        arr[k] = flags[k]
+    return arr
+
+
+def to_npy(res, shape):
+    """
+    Encodes results as a .npy file. If there are flags, the file contains a
+    structured array with the given shape (that of the queried coordinates),
+    with the results in the field 'result', and one field per flag.
+    """
+    buf = IO()
+    np.save(buf, npy_array(res, len(shape)))
+    return buf.getvalue()
+
+
+def stream_npy(chunks, shape):
+    """
+    Generates the same .npy file as ``to_npy``, from the results of a query
+    in consecutive chunks of the flattened coordinates.
+    """
+    dtype = None
+    for res in chunks:
+        arr = npy_array(res, 1)
+        if dtype is None:
+            dtype = arr.dtype
+            buf = IO()
+            np.lib.format.write_array_header_1_0(buf, {
+                'descr': np.lib.format.dtype_to_descr(dtype),
+                'fortran_order': False,
+                'shape': tuple(shape) + arr.shape[1:]})
+            yield buf.getvalue()
+        yield arr.astype(dtype, copy=False).tobytes()
+
+
+def _arrow_batch(res, n_coord_dims, dtype=None):
+    # Converts results (and flags) to an Arrow record batch.
+    res, flags = split_result(res)
+    if dtype is not None:
+        res = res.astype(dtype, copy=False)
+    n_rows = int(np.prod(res.shape[:n_coord_dims]))
+    n_values = res.size // n_rows if n_rows else 0
+
+    names = ['result']
+    if res.ndim == n_coord_dims:
+        columns = [pyarrow.array(res.ravel())]
+    else:
+        columns = [pyarrow.FixedSizeListArray.from_arrays(
+            pyarrow.array(res.ravel()), n_values)]
+
+    if flags is not None:
+        for k in flags.dtype.names:
+            names.append(k)
+            columns.append(pyarrow.array(flags[k].ravel()))
+
+    return pyarrow.RecordBatch.from_arrays(columns, names)
+
+
+def _arrow_schema(batch, shape, res_shape, dtype):
+    # Attaches the shapes of the coordinates and results to the schema.
+    return batch.schema.with_metadata({
+        'coord_shape': json.dumps(list(shape)),
+        'shape': json.dumps(list(res_shape)),
+        'dtype': dtype.str})
+
+
+def to_arrow(res, shape):
+    """
+    Encodes results as an Arrow IPC stream, with one row per coordinate (the
+    coordinates having the given shape). The column 'result' holds the
+    value(s) for each coordinate (as a fixed-size list, if there are several
+    per coordinate), and there is one column per flag. The shapes of the
+    coordinates and of the results are stored in the schema metadata.
+    """
+    res_arr = split_result(res)[0]
+    batch = _arrow_batch(res, len(shape))
+    schema = _arrow_schema(batch, shape, res_arr.shape, res_arr.dtype)
+
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.RecordBatchStreamWriter(sink, schema)
+    writer.write_batch(batch)
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+
+def stream_arrow(chunks, shape):
+    """
+    Generates an Arrow IPC stream, like ``to_arrow``, from the results of a
+    query in consecutive chunks of the flattened coordinates. Each chunk
+    becomes one record batch.
+    """
+    buf = IO()
+    writer = None
+    dtype = None
+    for res in chunks:
+        batch = _arrow_batch(res, 1, dtype=dtype)
+        if writer is None:
+            res_arr = split_result(res)[0]
+            dtype = res_arr.dtype
+            schema = _arrow_schema(
+                batch, shape,
+                tuple(shape) + res_arr.shape[1:],
+                dtype)
+            writer = pyarrow.RecordBatchStreamWriter(buf, schema)
+        writer.write_batch(batch)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    writer.close()
+    yield buf.getvalue()
+
+
+def _msgpack_array(x):
+    x = np.asarray(x)
+    if x.dtype.names is None:
+        dtype = x.dtype.str
+    else:
+        dtype = x.dtype.descr
+    return {
+        'dtype': dtype,
+        'shape': list(x.shape),
+        'data': x.tobytes()}
+
+
+def to_msgpack(res, shape):
+    """
+    Encodes results as a msgpack map. The results (and flags) are maps with
+    the keys 'dtype', 'shape' and 'data' (the raw array buffer). The shape of
+    the queried coordinates is stored under 'coord_shape'.
+    """
+    res, flags = split_result(res)
+    d = {'coord_shape': list(shape), 'result': _msgpack_array(res)}
+    if flags is not None:
+        d['flags'] = _msgpack_array(flags)
+    return msgpack.packb(d, use_bin_type=True)
+
+
+# Encoders for each MIME type. JSON comes first, so that it is used when the
+# client accepts any format.
+encoders = [('application/json', None)]
+encoders.append(('application/x-npy', to_npy))
+if pyarrow is not None:
+    encoders.append(('application/vnd.apache.arrow.stream', to_arrow))
+if msgpack is not None:
+    encoders.append(('application/x-msgpack', to_msgpack))
+
+
+# Short names of the formats, for the "format" query parameter
+format_names = {
+    'json': 'application/json',
+    'npy': 'application/x-npy',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'msgpack': 'application/x-msgpack'}
+
+
+def negotiate():
+    """
+    Returns the MIME type of the response format. A format requested
+    explicitly (by the "format" query parameter, as a short name or MIME
+    type) is used if it is available, and otherwise ``None`` is returned.
+    If no format is requested explicitly, the best match to the Accept
+    header is used, or JSON, if no available format matches.
+    """
+    available = [m for m,_ in encoders]
+
+    fmt = request.args.get('format')
+    if fmt is not None:
+        mimetype = format_names.get(fmt.lower(), fmt.lower())
+        return mimetype if mimetype in available else None
+
+    if not request.accept_mimetypes:
+        return available[0]
+    return request.accept_mimetypes.best_match(available) or available[0]
+
+
+def encode(res, shape, mimetype):
+    """
+    Returns a response containing the query results in the given format.
+    ``shape`` is the shape of the queried coordinates.
+    """
+    encoder = dict(encoders)[mimetype]
+    if encoder is None:
+        response = jsonify(res)
+    else:
+        response = Response(encoder(res, shape), mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+# Streaming encoders, for formats that support them
+stream_encoders = {'application/x-npy': stream_npy}
+if pyarrow is not None:
+    stream_encoders['application/vnd.apache.arrow.stream'] = stream_arrow
+
+
+def encode_stream(chunks, shape, mimetype):
+    """
+    Returns a streamed response containing the query results in the given
+    format. ``chunks`` is an iterator over the results of the query in
+    consecutive chunks of the flattened coordinates, which have the given
+    shape.
+    """
+    encoder = stream_encoders[mimetype]
+    response = Response(
+        stream_with_context(encoder(chunks, shape)),
+        mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def not_acceptable_message():
+    names = dict((m, k) for k,m in format_names.items())
+    msg = 'The requested response format is not available.\n'
+    msg += 'Available formats: {}'.format(', '.join(
+        '{} ({})'.format(names[m], m) for m,_ in encoders))
+    return msg, 406
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  result_cache.py
+#  Cache of encoded /api/v2 query responses, stored in Redis.
+#
+#  Entries are keyed by a hash of the map (including the signature of the
+#  loaded map file, so that reloading a map invalidates its entries), the
+#  response format, the query arguments and the coordinates (converted to
+#  Galactic coordinates). The response bodies are stored zlib-compressed.
+#
+#  Entries expire a fixed time after they were last used. In addition, the
+#  total size of the cache is tracked, and the least recently used entries
+#  are evicted when it exceeds its maximum size. The index of entries and
+#  their sizes are updated by server-side (Lua) scripts, so that concurrent
+#  workers keep the total consistent. Queries that draw random samples are
+#  only cached if they are seeded.
+#
+
+from __future__ import print_function, division
+
+from map3d import redis
+
+import time
+import json
+import zlib
+import hashlib
+
+import numpy as np
+
+from config import (result_cache_ttl, result_cache_max_bytes,
+                    result_cache_max_entry_bytes)
+
+
+prefix = 'result-cache/'
+index_key = prefix + 'index'        # zset: entry key -> last access time
+sizes_key = prefix + 'sizes'        # hash: entry key -> size (in bytes)
+bytes_key = prefix + 'bytes'        # total size of entries (in bytes)
+hits_key = prefix + 'hits'
+misses_key = prefix + 'misses'
+
+
+def deterministic(kwargs):
+    """
+    Returns ``True`` if a query with the given keyword arguments always
+    returns the same results. Random sampling modes are deterministic only if
+    a seed is given.
+    """
+    if kwargs.get('seed') is not None:
+        return True
+    return not kwargs.get('mode', 'random_sample').startswith('random_sample')
+
+
+def cacheable(kwargs):
+    """
+    Returns ``True`` if the results of a query with the given keyword
+    arguments should be cached.
+    """
+    return (result_cache_max_bytes > 0) and deterministic(kwargs)
+
+
+def entry_key(map_name, map_signature, mimetype, coords, kwargs):
+    """
+    Returns the cache key of a query of the given map, in the given response
+    format, at the given coordinates (a GalCoords object), with the given
+    keyword arguments.
+    """
+    kwargs = {
+        k: v.tolist() if isinstance(v, np.ndarray) else v
+        for k,v in kwargs.items()}
+
+    h = hashlib.sha1()
+    txt = json.dumps(
+        [map_name, map_signature, mimetype, kwargs, list(coords.shape),
+         coords.d is not None],
+        sort_keys=True)
+    h.update(txt.encode('utf-8'))
+    for x in coords.flat():
+        if x is not None:
+            h.update(np.ascontiguousarray(x, dtype='<f8').tobytes())
+
+    return prefix + 'entry/' + h.hexdigest()
+
+
+# Stores an entry (KEYS[4]) with the given value (ARGV[1]), TTL (ARGV[2], in
+# milliseconds) and access time (ARGV[3]), unless it already exists, and adds it
+# to the index (KEYS[1]), sizes (KEYS[2]) and total size (KEYS[3]). The size
+# of an expired entry that is still in the index is subtracted first.
+# Returns whether the entry was stored.
+put_script = """
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    return 0
+end
+local old = redis.call('HGET', KEYS[2], KEYS[4])
+if old then
+    redis.call('DECRBY', KEYS[3], old)
+end
+local size = string.len(ARGV[1])
+redis.call('SET', KEYS[4], ARGV[1], 'PX', ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], KEYS[4])
+redis.call('HSET', KEYS[2], KEYS[4], size)
+redis.call('INCRBY', KEYS[3], size)
+return 1
+"""
+
+# Removes the given entries (KEYS[4], ...) from the cache and from the index
+# (KEYS[1]) and sizes (KEYS[2]), and subtracts their sizes from the total
+# (KEYS[3]). Entries that have already been removed (e.g., by another
+# worker) are skipped, so that their sizes are only subtracted once.
+remove_script = """
+local n_bytes = 0
+for i = 4, #KEYS do
+    local size = redis.call('HGET', KEYS[2], KEYS[i])
+    if size then
+        n_bytes = n_bytes + tonumber(size)
+        redis.call('HDEL', KEYS[2], KEYS[i])
+    end
+    redis.call('DEL', KEYS[i])
+    redis.call('ZREM', KEYS[1], KEYS[i])
+end
+if n_bytes > 0 then
+    redis.call('DECRBY', KEYS[3], n_bytes)
+end
+return n_bytes
+"""
+
+_put = redis.register_script(put_script)
+_remove_entries = redis.register_script(remove_script)
+
+
+def _ttl_ms():
+    # In milliseconds, so that fractional TTLs (even below 1 s) are kept
+    return max(1, int(1000*result_cache_ttl))
+
+
+def get(key):
+    """
+    Returns the mimetype and body of the cached response with the given key,
+    or ``None`` if there is no such entry. The entry's expiry time is reset.
+    """
+    value = redis.get(key)
+    if value is None:
+        redis.incr(misses_key)
+        return None
+
+    p = redis.pipeline()
+    p.execute_command('ZADD', index_key, time.time(), key)
+    p.pexpire(key, _ttl_ms())
+    p.incr(hits_key)
+    p.execute()
+
+    mimetype, body = value.split(b'\n', 1)
+    return mimetype.decode('utf-8'), zlib.decompress(body)
+
+
+def put(key, mimetype, body):
+    """
+    Stores the mimetype and body of a response under the given key (unless
+    it is already cached), and then evicts old entries, if necessary.
+    """
+    value = mimetype.encode('utf-8') + b'\n' + zlib.compress(body, 6)
+    if len(value) > result_cache_max_entry_bytes:
+        return
+
+    if _put(keys=[index_key, sizes_key, bytes_key, key],
+            args=[value, _ttl_ms(), repr(time.time())]):
+        evict()
+
+
+def _remove(keys):
+    # Removes the given entries, and subtracts their sizes from the total
+    if keys:
+        _remove_entries(keys=[index_key, sizes_key, bytes_key] + list(keys))
+
+
+def evict(batch_size=16):
+    """
+    Removes expired entries from the index, and then the least recently used
+    entries, until the cache fits within its maximum size.
+    """
+    t_expired = time.time() - result_cache_ttl
+    _remove(redis.zrangebyscore(index_key, '-inf', t_expired))
+
+    while True:
+        excess = int(redis.get(bytes_key) or 0) - result_cache_max_bytes
+        if excess <= 0:
+            break
+        keys = redis.zrange(index_key, 0, batch_size-1)
+        if not keys:
+            break
+
+        # Remove only as many of the oldest entries as needed
+        sizes = redis.hmget(sizes_key, keys)
+        n_remove = 0
+        for s in sizes:
+            n_remove += 1
+            excess -= int(s or 0)
+            if excess <= 0:
+                break
+        _remove(keys[:n_remove])
+
+
+def stats():
+    """
+    Returns the numbers of hits and misses, and the number and total size of
+    the cached entries.
+    """
+    p = redis.pipeline()
+    p.get(hits_key)
+    p.get(misses_key)
+    p.zcard(index_key)
+    p.get(bytes_key)
+    hits, misses, n_entries, n_bytes = p.execute()
+    return {
+        'hits': int(hits or 0),
+        'misses': int(misses or 0),
+        'entries': int(n_entries or 0),
+        'bytes': int(n_bytes or 0)}
@@ -829,6 +829,39 @@ function create_plot() {
     $("#ps-label-1").text(data.label1);
     $("#ps-label-2").text(data.label2);
     $("#ps-label-3").text(data.label3);
+    place_bullseye(data);
+  };
+
+  var get_ps_center = function(query_data) {
+    // The stamps may be centred slightly away from the queried coordinates
+    // (on the grid on which the server caches them)
+    if (query_data.stamp_l === undefined) {
+      return {"l": query_data.l, "b": query_data.b};
+    }
+    return {"l": query_data.stamp_l, "b": query_data.stamp_b};
+  };
+
+  var place_bullseye = function(query_data) {
+    // Marks the queried coordinates on the stamps
+    var x_max_proj = astrocoords.proj_gnomonic(
+      astrocoords.deg2rad(query_data.radius),
+      0, 0, 1, 0
+    ).x;
+    var center = get_ps_center(query_data);
+    var lat0 = astrocoords.deg2rad(center.b);
+    var xy = astrocoords.proj_gnomonic(
+      astrocoords.deg2rad(query_data.l),
+      astrocoords.deg2rad(query_data.b),
+      astrocoords.deg2rad(center.l),
+      Math.cos(lat0), Math.sin(lat0)
+    );
+
+    // Inverse of the transformation in get_ps_lb (in the 300 x 300 viewbox
+    // of the overlays)
+    var x = 150 * (1 - xy.x / x_max_proj);
+    var y = 150 * (1 - xy.y / x_max_proj);
+    d3.selectAll(".ps-bullseye")
+      .attr("transform", "translate(" + x + "," + y + ")");
   };
 
   var update_ps_dimensions = function() {
@@ -850,8 +883,9 @@ function create_plot() {
       0, 0, 1, 0
     ).x;
     var mouse_xy = d3.mouse(obj);
-    var lon0 = astrocoords.deg2rad(query_data.l),
-        lat0 = astrocoords.deg2rad(query_data.b);
+    var center = get_ps_center(query_data);
+    var lon0 = astrocoords.deg2rad(center.l),
+        lat0 = astrocoords.deg2rad(center.b);
     var width = d3.select(obj).attr("width");
 
     var x = -2 * (mouse_xy[0] / width - 0.5) * x_max_proj;
@@ -60,3 +60,34 @@ def filter_NaN(obj, replace=None):
         return replace
     else:
         return obj
+
+
+def memory_usage():
+    """
+    Returns the memory usage of this process (in bytes), split into memory
+    that is shared with other processes (e.g., memory-mapped map files) and
+    memory that is unique to this process. Requires the Linux /proc
+    filesystem. Returns ``None`` if it is unavailable.
+    """
+    fields = {}
+
+    for fname in ('/proc/self/smaps_rollup', '/proc/self/smaps'):
+        try:
+            with open(fname, 'r') as f:
+                for line in f:
+                    key, _, val = line.partition(':')
+                    val = val.split()
+                    if len(val) == 2 and val[1] == 'kB':
+                        fields[key] = fields.get(key, 0) + 1024 * int(val[0])
+            break
+        except IOError:
+            continue
+    else:
+        return None
+
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        'unique': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    }
@@ -16,6 +16,8 @@ import astropy.units as units
 from astropy.coordinates import SkyCoord
 from astropy.units import Quantity
 
+from fastquery import GalCoords
+
 
 class ExtendedValidator(Validator):
     def __init__(self, *args, **kwargs):
@@ -181,6 +183,20 @@ common_validators = {
             'default': 'full'
         }
     },
+    'multi-map': {
+        'maps': {
+            'required': True,
+            'type': 'list',
+            'minlength': 1,
+            'schema': {'type': 'string'}
+        },
+        'kwargs': {
+            'required': False,
+            'type': 'dict',
+            'valueschema': {'type': 'dict'},
+            'default': {}
+        }
+    },
     'equ-frame': {
         'frame': {
             'required': False,
@@ -283,7 +299,19 @@ def validate_qstring(*schemata, **kw):
     return decorator
 
 
-def skycoords_from_args():
+def to_float_array(value, unit):
+    if value is None:
+        return None
+    return value.to(unit).value
+
+
+def skycoords_from_args(fast=False):
+    """
+    Collects the coordinates in the request arguments into a SkyCoord
+    object, which is passed to the view as its first argument. If ``fast``
+    is ``True``, Galactic and ICRS coordinates are instead passed as a
+    GalCoords object (plain float arrays), avoiding the overhead of SkyCoord.
+    """
     def decorator(f):
         @functools.wraps(f)
         def with_skycoords(*args, **kwargs):
@@ -291,6 +319,17 @@ def skycoords_from_args():
 
             if 'coords' in g.args:
                 coords = g.args.pop('coords')
+            elif fast and ('l' in g.args):
+                coords = GalCoords(
+                    to_float_array(g.args.pop('l'), units.deg),
+                    to_float_array(g.args.pop('b'), units.deg),
+                    d=to_float_array(g.args.pop('d', None), units.kpc))
+            elif fast and ('ra' in g.args) and (g.args.get('frame', 'icrs') == 'icrs'):
+                g.args.pop('frame', None)
+                coords = GalCoords.from_icrs(
+                    to_float_array(g.args.pop('ra'), units.deg),
+                    to_float_array(g.args.pop('dec'), units.deg),
+                    d=to_float_array(g.args.pop('d', None), units.kpc))
             elif 'l' in g.args:
                 coords = SkyCoord(
                     g.args.pop('l'),
@@ -1,11 +1,13 @@
 from map3d import app
 
-from flask import render_template, redirect, request, jsonify, Response, g
+from flask import render_template, redirect, request, jsonify, Response, g, send_file, url_for
 from cerberus import Validator
 import numpy as np
 import json
 import time
 import os
+import hmac
+import itertools
 
 from astropy import units
 from astropy.coordinates import SkyCoord
@@ -13,7 +15,7 @@ from astropy.coordinates import SkyCoord
 script_dir = os.path.dirname(os.path.realpath(__file__))
 log_path = os.path.join(script_dir, '..', 'log', 'argonaut_requests.log')
 
-from rate_limit import ratelimit
+from rate_limit import ratelimit, charge_cost
 from gzip_response import gzipped
 from validators import validate_json, validate_qstring, skycoords_from_args, ExtendedValidator
 
@@ -24,14 +26,35 @@ import postage_stamp
 import mapdata
 import loscurves
 import snippets
+import fastquery
+import response_formats
+import jobs
+import result_cache
+import coalesce
+import multiquery
+import parallel
+import cost_model
+import los_cache
 
-from utils import array_like, filter_dict, filter_NaN
+from utils import array_like, filter_dict, filter_NaN, memory_usage
+
+from config import stream_min_coords, stream_chunk_size, job_max_size
+from config import rate_limit_costs, status_token, proxy_count
 
 from dustmaps import json_serializers
 app.json_decoder = json_serializers.MultiJSONDecoder
 app.json_encoder = json_serializers.get_encoder(ndarray_mode='b64')
 
 
+#
+# Reload maps whose files have changed
+#
+
+@app.before_request
+def check_map_files():
+    mapdata.check_for_updates()
+
+
 #
 # Web pages
 #
@@ -69,15 +92,60 @@ def over_limit_message(rlimit):
     )
     return msg, 429
 
+def status_authorized():
+    """
+    Returns ``True`` if the request may see the detailed server status: if it
+    carries the status token, or comes from this host. Behind a proxy, every
+    request may appear to come from this host (e.g., if the proxy does not
+    set X-Forwarded-For), so the token is always required.
+    """
+    if (proxy_count == 0) and (request.remote_addr in ('127.0.0.1', '::1')):
+        return True
+    token = request.headers.get('X-Status-Token')
+    if (status_token is None) or (token is None):
+        return False
+    return hmac.compare_digest(token.encode('utf-8'), status_token.encode('utf-8'))
+
+@app.route('/api/v2/status', methods=['GET'])
+@ratelimit(limit=30, per=60, send_x_headers=False)
+def api_v2_status():
+    if not status_authorized():
+        return jsonify({'ok': True})
+    return jsonify({
+        'ok': True,
+        'pid': os.getpid(),
+        'memory': memory_usage(),
+        'maps': mapdata.status(),
+        'result_cache': result_cache.stats(),
+        'cost_model': cost_model.status(),
+        'los_cache': los_cache.stats()})
+
+def validate_map_args(handler, args=None):
+    """
+    Validates the keyword arguments of a map query (by default, those in
+    ``g.args``) against the handler's schema. Returns an error response, or
+    ``None`` if the arguments are valid.
+    """
+    if args is None:
+        args = g.args
+    if 'schema' in handler:
+        v = ExtendedValidator(handler['schema'], allow_unknown=False)
+        if not v.validate(args):
+            msg = 'Invalid keyword arguments.\n'
+            msg += json.dumps(v.errors, indent=2)
+            return msg, 400
+    return None
+
 @app.route('/api/v2/<map_name>/query', methods=['POST'])
 @ratelimit(limit=300, per=5*60,
            send_x_headers=True,
-           over_limit=over_limit_message)
+           over_limit=over_limit_message,
+           cost_limit=rate_limit_costs.get('api_v2'))
 @gzipped(6)
 @validate_json('skycoord', 'gal', 'equ',
                'distance', 'equ-frame',
                allow_unknown=True)
-@skycoords_from_args()
+@skycoords_from_args(fast=True)
 def api_v2(coords, map_name):
     # Check map name
     if map_name not in mapdata.handlers:
@@ -88,22 +156,94 @@ def api_v2(coords, map_name):
 
     # Select correct map to query
     handler = mapdata.handlers[map_name]
-    if 'schema' in handler:
-        v = ExtendedValidator(handler['schema'], allow_unknown=False)
-        if not v.validate(g.args):
-            msg = 'Invalid keyword arguments.\n'
-            msg += json.dumps(v.errors, indent=2)
-            return msg, 400
-    if 'size_checker' in handler:
-        success, q_size, q_size_max = handler['size_checker'](coords, **g.args)
-        if not success:
-            msg = 'Requested output is too large (requested: {:d}, max: {:d})'
-            msg = msg.format(q_size, int(q_size_max))
-            return msg, 413
+    err = validate_map_args(handler)
+    if err is not None:
+        return err
+
+    # Determine the response format
+    mimetype = response_formats.negotiate()
+    if mimetype is None:
+        return response_formats.not_acceptable_message()
+
+    # Large queries are processed and sent in chunks, if the response format
+    # allows it. In unseeded "random_sample_per_pix" mode, all coordinates
+    # have to be queried together, so that those in the same pixel get the
+    # same sample.
+    stream = (
+        (mimetype in response_formats.stream_encoders) and
+        ('query_gal' in handler) and
+        (g.n_coords >= stream_min_coords) and
+        parallel.chunkable(g.args))
+
+    # Reject queries that are estimated to be too expensive
+    cost = cost_model.estimate(
+        map_name, handler, coords, g.args,
+        mimetype=mimetype,
+        chunk_size=stream_chunk_size if stream else None)
+    err = cost_model.check('api_v2', cost)
+    if err is not None:
+        return err
+
+    # Charge the size of the query to the client's budget
+    err = charge_cost(handler['query_size'](coords, **g.args))
+    if err is not None:
+        return err
+
+    # The query object and the signature of the map it was loaded from (read
+    # together, so that cached results are stored under the right map)
+    q, signature = handler.lazy_q.get_signed()
+
+    # Return the cached response, if there is one, or wait for an identical
+    # query that is already running
+    cache_key = None
+    if (not stream) and result_cache.deterministic(g.args):
+        cache_key = result_cache.entry_key(
+            map_name,
+            signature,
+            mimetype,
+            fastquery.as_gal(coords),
+            g.args)
+
+        if result_cache.cacheable(g.args):
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                logger.write(
+                    '/api/v2/{}/query: {} coordinates requested by {} '
+                    '(cached)'.format(map_name, g.n_coords, request.remote_addr))
+                response = Response(cached[1], mimetype=cached[0])
+                response.vary.add('Accept')
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+        response = coalesce.join(cache_key)
+        if response is not None:
+            logger.write(
+                '/api/v2/{}/query: {} coordinates requested by {} '
+                '(coalesced)'.format(map_name, g.n_coords, request.remote_addr))
+            response.vary.add('Accept')
+            return response
 
     # Conduct the query
     try:
-        res = handler['q'](coords, **g.args)
+        if stream:
+            chunks = (
+                parallel.query_gal(handler, c, q=q, **g.args)
+                for c in fastquery.as_gal(coords).chunks(stream_chunk_size))
+            # Query the first chunk now, so that errors are reported normally
+            res = itertools.chain([next(chunks)], chunks)
+        else:
+            t_cpu = cost_model.cpu_time()
+            if 'query_gal' in handler:
+                res = parallel.query_gal(
+                    handler,
+                    fastquery.as_gal(coords),
+                    q=q,
+                    **g.args)
+            else:
+                res = q(fastquery.as_skycoord(coords), **g.args)
+            cost_model.observe(
+                map_name, handler, coords, g.args,
+                cost_model.cpu_time() - t_cpu)
     except Exception as err:
         msg = 'An unexpected error occurred while executing the query.\n'
         msg += str(err)
@@ -123,6 +263,8 @@ def api_v2(coords, map_name):
     txt_request = ('/api/v2/{map_name}/query: ' +
                    '{n_coords} coordinates requested by {ip} ' +
                    '(t: {delta_t:.2f} s, t/coord: {t_per_coord:.2g} s)')
+    if stream:
+        txt_request += ' (streamed; t: first chunk)'
     txt_request = txt_request.format(
         map_name=map_name,
         ip=request.remote_addr,
@@ -131,10 +273,188 @@ def api_v2(coords, map_name):
         t_per_coord=(t_end-t_start) / max(1, g.n_coords))
     logger.write(txt_request)
 
+    # Encode and return the results
+    if stream:
+        return response_formats.encode_stream(res, coords.shape, mimetype)
+    response = response_formats.encode(res, coords.shape, mimetype)
+
+    # Cache the response, and share it with identical queries waiting for it
+    if cache_key is not None:
+        coalesce.publish(cache_key, response)
+        if result_cache.cacheable(g.args):
+            result_cache.put(cache_key, mimetype, response.get_data())
+            response.headers['X-Cache'] = 'MISS'
+
+    return response
+
+
+@app.route('/api/v2/query', methods=['POST'])
+@ratelimit(limit=300, per=5*60,
+           send_x_headers=True,
+           over_limit=over_limit_message,
+           cost_limit=rate_limit_costs.get('api_v2_multi'))
+@gzipped(6)
+@validate_json('skycoord', 'gal', 'equ',
+               'distance', 'equ-frame', 'multi-map',
+               allow_unknown=True)
+@skycoords_from_args(fast=True)
+def api_v2_multi(coords):
+    names = g.args.pop('maps')
+    map_kwargs = g.args.pop('kwargs')
+
+    # Check map names and arguments
+    for name in names:
+        if (name not in mapdata.handlers) or \
+                ('query_gal' not in mapdata.handlers[name]):
+            msg = 'Invalid map name: "{}".'.format(name)
+            return msg, 400
+    if len(set(names)) != len(names):
+        return 'Each map may only be requested once.', 400
+    for name in map_kwargs:
+        if name not in names:
+            msg = 'Keyword arguments given for unrequested map: "{}".'
+            return msg.format(name), 400
+    if g.args:
+        msg = 'Unknown arguments: {}. Keyword arguments for each map '
+        msg += 'should be given in "kwargs".'
+        return msg.format(', '.join(sorted(g.args.keys()))), 400
+
+    t_start = time.time()
+
+    for name in names:
+        handler = mapdata.handlers[name]
+        kw = map_kwargs.get(name, {})
+        err = validate_map_args(handler, kw)
+        if err is not None:
+            return err
+
+    # Reject queries that are estimated to be too expensive
+    cost = cost_model.Cost()
+    for name in names:
+        cost += cost_model.estimate(
+            name, mapdata.handlers[name], coords, map_kwargs.get(name, {}))
+    err = cost_model.check('api_v2_multi', cost)
+    if err is not None:
+        return err
+
+    # Charge the size of the query to the client's budget
+    err = charge_cost(sum(
+        mapdata.handlers[name]['query_size'](coords, **map_kwargs.get(name, {}))
+        for name in names))
+    if err is not None:
+        return err
+
+    # Conduct the queries
+    try:
+        res = multiquery.query_maps(
+            mapdata.handlers,
+            names,
+            fastquery.as_gal(coords),
+            map_kwargs)
+    except Exception as err:
+        msg = 'An unexpected error occurred while executing the query.\n'
+        msg += str(err)
+        return msg, 500
+
+    t_end = time.time()
+
+    # Log the query
+    txt_request = ('/api/v2/query: ' +
+                   '{n_coords} coordinates in {n_maps} maps requested by {ip} ' +
+                   '(t: {delta_t:.2f} s, t/coord: {t_per_coord:.2g} s)')
+    txt_request = txt_request.format(
+        n_maps=len(names),
+        ip=request.remote_addr,
+        n_coords=g.n_coords,
+        delta_t=t_end-t_start,
+        t_per_coord=(t_end-t_start) / max(1, g.n_coords))
+    logger.write(txt_request)
+
     # JSONify and return the results
     return jsonify(res)
 
 
+###########################################################################
+# Asynchronous bulk query jobs
+###########################################################################
+
+@app.route('/api/v2/<map_name>/jobs', methods=['POST'])
+@ratelimit(limit=30, per=60*60,
+           send_x_headers=True,
+           over_limit=over_limit_message,
+           cost_limit=rate_limit_costs.get('api_v2_jobs'))
+@validate_json('skycoord', 'gal', 'equ',
+               'distance', 'equ-frame',
+               allow_unknown=True)
+@skycoords_from_args(fast=True)
+def api_v2_submit_job(coords, map_name):
+    # Check map name
+    if map_name not in mapdata.handlers:
+        msg = 'Invalid map name: "{}".'.format(map_name)
+        return msg, 400
+
+    handler = mapdata.handlers[map_name]
+    err = validate_map_args(handler)
+    if err is not None:
+        return err
+
+    f_size = handler.get('query_size', mapdata.default_query_size)
+    q_size = f_size(coords, **g.args)
+    if q_size > job_max_size:
+        msg = 'Requested output is too large (requested: {:d}, max: {:d})'
+        msg = msg.format(q_size, int(job_max_size))
+        return msg, 413
+
+    # Charge the size of the job to the client's budget
+    err = charge_cost(q_size)
+    if err is not None:
+        return err
+
+    gal = fastquery.as_gal(coords)
+    job_id = jobs.create(
+        map_name, gal, g.args,
+        jobs.estimate_bytes(gal, q_size))
+    if job_id is None:
+        msg = ('There is not enough space left for new jobs. Please try '
+               'again later.')
+        return msg, 503
+
+    logger.write(
+        '/api/v2/{}/jobs: {} coordinates submitted by {} (job {})'.format(
+            map_name, g.n_coords, request.remote_addr, job_id))
+
+    res = jobs.status(job_id)
+    res['status_url'] = url_for('api_v2_job_status', job_id=job_id)
+    res['result_url'] = url_for('api_v2_job_result', job_id=job_id)
+    response = jsonify(res)
+    response.status_code = 202
+    response.headers['Location'] = res['status_url']
+    return response
+
+@app.route('/api/v2/jobs/<job_id>', methods=['GET'])
+@ratelimit(limit=300, per=5*60, send_x_headers=True)
+def api_v2_job_status(job_id):
+    res = jobs.status(job_id)
+    if res is None:
+        return 'Unknown job: "{}".'.format(job_id), 404
+    return jsonify(res)
+
+@app.route('/api/v2/jobs/<job_id>/result', methods=['GET'])
+@ratelimit(limit=30, per=5*60, send_x_headers=True)
+def api_v2_job_result(job_id):
+    res = jobs.status(job_id)
+    if res is None:
+        return 'Unknown job: "{}".'.format(job_id), 404
+    if res['status'] != 'done':
+        msg = 'Job "{}" has not finished (status: {}).'.format(
+            job_id, res['status'])
+        return msg, 409
+    return send_file(
+        jobs.result_fname(job_id),
+        mimetype='application/x-npy',
+        conditional=True)
+
+
 ###########################################################################
 # Interactive Website
 ###########################################################################
@@ -154,18 +474,31 @@ def interactive_data(coords, map_name):
     if coords.frame.name != 'galactic':
         coords = coords.transform_to('galactic')
 
+    gal = fastquery.as_gal(coords)
+
+    # The query object and the signature of the map it was loaded from (read
+    # together, so that cached results are stored under the right map)
+    query_obj, signature = mapdata.handlers[map_name].lazy_q.get_signed()
+
+    # Wait for an identical request that is already running
+    flight_key = request.endpoint + '/' + result_cache.entry_key(
+        map_name,
+        signature,
+        'application/json',
+        gal,
+        {})
+    response = coalesce.join(flight_key)
+    if response is not None:
+        return response
+
     t1 = time.time()
 
-    # Execute query
-    query_obj = mapdata.handlers[map_name]['q']
-    samples, flags = query_obj(
-        coords,
-        mode='samples',
-        return_flags=True)
+    # Execute query (samples and best fit, cached per map pixel)
+    samples, best, flags = los_cache.samples_best(
+        map_name, signature, query_obj, gal)
 
     t2 = time.time()
 
-    best = query_obj(coords, mode='best')
     distmod = (query_obj.distmods/units.mag).decompose().value
     
     # Convert to E(g-r)
@@ -177,18 +510,18 @@ def interactive_data(coords, map_name):
 
     t3 = time.time()
 
-    # Postage Stamps
+    # Postage Stamps (cached per snapped stamp centre)
     dists = [300., 1000., 5000.]
     radius = postage_stamp.radius
-    img = postage_stamp.postage_stamps(
+    img, (stamp_l, stamp_b) = los_cache.encoded_stamps(
         map_name,
+        signature,
         coords.l.deg,
         coords.b.deg,
-        dists=dists)
+        dists)
 
     t4 = time.time()
 
-    img = [postage_stamp.encode_image(img_d) for img_d in img]
     label = ['{:.0f} pc'.format(d) for d in dists]
 
     t5 = time.time()
@@ -201,6 +534,8 @@ def interactive_data(coords, map_name):
         'success': success,
         'l': coords.l.deg,
         'b': coords.b.deg,
+        'stamp_l': stamp_l,
+        'stamp_b': stamp_b,
         'radius': radius,
         'samples': samples.tolist(),
         'best': best.tolist(),
@@ -217,13 +552,15 @@ def interactive_data(coords, map_name):
 
     print('time inside query: {:.4f} s'.format(t6-t0))
     print('{: >7.4f} s : {: >6.4f} s : transform to galactic'.format(t1-t0, t1-t0))
-    print('{: >7.4f} s : {: >6.4f} s : query samples'.format(t2-t0, t2-t1))
-    print('{: >7.4f} s : {: >6.4f} s : query best'.format(t3-t0, t3-t2))
-    print('{: >7.4f} s : {: >6.4f} s : rasterize postage stamps'.format(t4-t0, t4-t3))
-    print('{: >7.4f} s : {: >6.4f} s : encode postage stamps'.format(t5-t0, t5-t4))
+    print('{: >7.4f} s : {: >6.4f} s : query samples and best'.format(t2-t0, t2-t1))
+    print('{: >7.4f} s : {: >6.4f} s : convert results'.format(t3-t0, t3-t2))
+    print('{: >7.4f} s : {: >6.4f} s : rasterize and encode postage stamps'.format(t4-t0, t4-t3))
+    print('{: >7.4f} s : {: >6.4f} s : labels'.format(t5-t0, t5-t4))
     print('{: >7.4f} s : {: >6.4f} s : collect results'.format(t6-t0, t6-t5))
 
-    return jsonify(res)
+    response = jsonify(res)
+    coalesce.publish(flight_key, response)
+    return response
 
 
 @app.route('/api/v2/interactive/<map_name>/lostable', methods=['GET'])
@@ -243,16 +580,16 @@ def interactive_table(coords, map_name):
 
     t1 = time.time()
 
-    # Execute query
-    query_obj = mapdata.handlers[map_name]['q']
-    samples, flags = query_obj(
-        coords,
-        mode='samples',
-        return_flags=True)
+    # Execute query (samples and best fit, cached per map pixel)
+    query_obj, signature = mapdata.handlers[map_name].lazy_q.get_signed()
+    samples, best, flags = los_cache.samples_best(
+        map_name,
+        signature,
+        query_obj,
+        fastquery.as_gal(coords))
 
     t2 = time.time()
 
-    best = query_obj(coords, mode='best')
     distmod = (query_obj.distmods/units.mag).decompose().value
     
     # Convert to E(g-r)
@@ -274,8 +611,8 @@ def interactive_table(coords, map_name):
 
     print('time inside query: {:.4f} s'.format(t4-t0))
     print('{: >7.4f} s : {: >6.4f} s : transform to galactic'.format(t1-t0, t1-t0))
-    print('{: >7.4f} s : {: >6.4f} s : query samples'.format(t2-t0, t2-t1))
-    print('{: >7.4f} s : {: >6.4f} s : query best'.format(t3-t0, t3-t2))
+    print('{: >7.4f} s : {: >6.4f} s : query samples and best'.format(t2-t0, t2-t1))
+    print('{: >7.4f} s : {: >6.4f} s : convert results'.format(t3-t0, t3-t2))
     print('{: >7.4f} s : {: >6.4f} s : ASCII table'.format(t4-t0, t4-t3))
 
     fname = "{:s}_l_{:.4f}_b_{:.4f}.txt".format(
@@ -312,21 +649,25 @@ def gal_lb_query_light(coords):
 
     if g.args['mode'] == 'full':
         query_obj = mapdata.handlers['bayestar2015']['q']
-        samples, flags = query_obj(coords, mode='samples', return_flags=True)
-        best = query_obj(coords, mode='best', return_flags=False)
+        samples, best, flags = fastquery.bayestar_query_samples_best(
+            query_obj,
+            fastquery.as_gal(coords))
         res['samples'] = samples
         res['best'] = best
         for key in flags.dtype.names:
             res[key] = flags[key]
         res['distmod'] = (query_obj.distmods / units.mag).decompose().value
     elif g.args['mode'] == 'lite':
+        # Percentiles are read from the precomputed summary statistics of the
+        # map, if available
         query_obj = mapdata.handlers['bayestar2015']['q']
-        pctiles, flags = query_obj(
-            coords,
+        gal = fastquery.as_gal(coords)
+        pctiles, flags = fastquery.bayestar_query(
+            query_obj, gal,
             mode='percentile',
             pct=[15.8, 50., 84.2],
             return_flags=True)
-        best = query_obj(coords, mode='best', return_flags=False)
+        best = fastquery.bayestar_query(query_obj, gal, mode='best')
         res['median'] = pctiles[...,1]
         res['sigma'] = 0.5 * (pctiles[...,2] - pctiles[...,0])
         res['best'] = best
@@ -379,32 +720,32 @@ def gal_lb_query(coords):
 
     t1 = time.time()
 
-    # Execute query
-    query_obj = mapdata.handlers['bayestar2015']['q']
-    samples, flags = query_obj(
-        coords,
-        mode='samples',
-        return_flags=True)
+    # Execute query (samples and best fit, cached per map pixel)
+    query_obj, signature = mapdata.handlers['bayestar2015'].lazy_q.get_signed()
+    samples, best, flags = los_cache.samples_best(
+        'bayestar2015',
+        signature,
+        query_obj,
+        fastquery.as_gal(coords))
 
     t2 = time.time()
 
-    best = query_obj(coords, mode='best')
     distmod = (query_obj.distmods/units.mag).decompose().value
 
     t3 = time.time()
 
-    # Postage Stamps
+    # Postage Stamps (cached per snapped stamp centre)
     dists = [300., 1000., 5000.]
     radius = postage_stamp.radius
-    img = postage_stamp.postage_stamps(
+    img, (stamp_l, stamp_b) = los_cache.encoded_stamps(
         'bayestar2015',
+        signature,
         coords.l.deg,
         coords.b.deg,
-        dists=dists)
+        dists)
 
     t4 = time.time()
 
-    img = [postage_stamp.encode_image(img_d) for img_d in img]
     label = ['{:.0f} pc'.format(d) for d in dists]
 
     t5 = time.time()
@@ -427,6 +768,8 @@ def gal_lb_query(coords):
         'success': success,
         'l': coords.l.deg,
         'b': coords.b.deg,
+        'stamp_l': stamp_l,
+        'stamp_b': stamp_b,
         'radius': radius,
         'table': table,
         'samples': samples.tolist(),
@@ -444,10 +787,10 @@ def gal_lb_query(coords):
 
     print('time inside query: {:.4f} s'.format(t7-t0))
     print('{: >7.4f} s : {: >6.4f} s : transform to galactic'.format(t1-t0, t1-t0))
-    print('{: >7.4f} s : {: >6.4f} s : query samples'.format(t2-t0, t2-t1))
-    print('{: >7.4f} s : {: >6.4f} s : query best'.format(t3-t0, t3-t2))
-    print('{: >7.4f} s : {: >6.4f} s : rasterize postage stamps'.format(t4-t0, t4-t3))
-    print('{: >7.4f} s : {: >6.4f} s : encode postage stamps'.format(t5-t0, t5-t4))
+    print('{: >7.4f} s : {: >6.4f} s : query samples and best'.format(t2-t0, t2-t1))
+    print('{: >7.4f} s : {: >6.4f} s : distance moduli'.format(t3-t0, t3-t2))
+    print('{: >7.4f} s : {: >6.4f} s : rasterize and encode postage stamps'.format(t4-t0, t4-t3))
+    print('{: >7.4f} s : {: >6.4f} s : labels'.format(t5-t0, t5-t4))
     print('{: >7.4f} s : {: >6.4f} s : ASCII table'.format(t6-t0, t6-t5))
     print('{: >7.4f} s : {: >6.4f} s : collect results'.format(t7-t0, t7-t6))
 
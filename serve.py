@@ -0,0 +1,80 @@
+#!venv/bin/python
+#
+# Production entry point. Loads the maps (and map images) once in a master
+# process, and then forks gunicorn worker processes, which inherit the
+# loaded map data copy-on-write. Workers start immediately, and only one
+# physical copy of the maps is held in memory.
+#
+# By default, binds to 127.0.0.1, to be run behind a reverse proxy. Set
+# MAP3D_PROXY_COUNT=1 (see config.py), so that clients are identified (and
+# rate-limited) by the address in the X-Forwarded-For header set by the
+# proxy, rather than all sharing the address of the proxy.
+#
+
+from __future__ import print_function
+
+from gunicorn.app.base import BaseApplication
+
+from map3d import app, mapdata, reinit_after_fork
+from config import proxy_count
+
+
+class PreforkApplication(BaseApplication):
+    def __init__(self, application, options=None):
+        self.application = application
+        self.options = options or {}
+        super(PreforkApplication, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def post_fork(server, worker):
+    reinit_after_fork()
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Load the maps, and then fork worker processes to serve "
+                    "the app.",
+        add_help=True)
+    parser.add_argument("--bind", "-b", metavar="ADDRESS",
+                        type=str, default="127.0.0.1:8000",
+                        help="Address to bind to.")
+    parser.add_argument("--workers", "-w", metavar="N",
+                        type=int, default=3,
+                        help="Number of worker processes.")
+    parser.add_argument("--timeout", "-t", metavar="SECONDS",
+                        type=int, default=120,
+                        help="Worker timeout.")
+    parser.add_argument("--maps", "-m", metavar="MAP",
+                        type=str, nargs='+', default=['all'],
+                        help="Maps to load before forking (default: all).")
+    args = parser.parse_args()
+
+    if proxy_count == 0:
+        print('Warning: MAP3D_PROXY_COUNT is not set. Behind a reverse '
+              'proxy, all clients will share the rate limits of the proxy '
+              'address.')
+
+    mapdata.preload(args.maps)
+
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'timeout': args.timeout,
+        'preload_app': True,
+        'post_fork': post_fork
+    }
+    PreforkApplication(app, options).run()
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
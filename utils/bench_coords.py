@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Benchmarks the conversion of coordinates to map pixels, comparing the
+# SkyCoord path with the plain-array fast path (map3d/fastquery.py). If a
+# Bayestar map file is given, full queries are also compared.
+#
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+
+import numpy as np
+import healpy as hp
+import astropy.units as units
+from astropy.coordinates import SkyCoord
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'map3d'))
+import fastquery
+
+
+def best_time(f, n_repeat):
+    t = []
+    for k in range(n_repeat):
+        t0 = time.time()
+        f()
+        t.append(time.time() - t0)
+    return min(t)
+
+
+def random_coords(n, seed=0):
+    rng = np.random.RandomState(seed)
+    lon = rng.uniform(0., 360., n)
+    lat = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+    return lon, lat
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Benchmark SkyCoord vs. plain-array coordinate handling.",
+        add_help=True)
+    parser.add_argument("--sizes", "-n", metavar="N",
+                        type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help="Numbers of coordinates to benchmark.")
+    parser.add_argument("--nside", metavar="NSIDE",
+                        type=int, default=1024,
+                        help="HEALPix nside used for the pixel lookup.")
+    parser.add_argument("--map", "-m", metavar="BAYESTAR.h5",
+                        type=str, default=None,
+                        help="Bayestar map, to benchmark full queries.")
+    parser.add_argument("--repeat", "-r", metavar="N",
+                        type=int, default=3,
+                        help="Number of repetitions (best time is reported).")
+    args = parser.parse_args()
+
+    q = None
+    if args.map is not None:
+        from dustmaps.bayestar import BayestarQuery
+        q = BayestarQuery(map_fname=args.map, max_samples=5)
+
+    def skycoord_pix(lon, lat, frame):
+        c = SkyCoord(lon*units.deg, lat*units.deg, frame=frame)
+        if frame != 'galactic':
+            c = c.transform_to('galactic')
+        return hp.pixelfunc.ang2pix(args.nside, c.l.deg, c.b.deg,
+                                    lonlat=True, nest=True)
+
+    def fast_pix(lon, lat, frame):
+        if frame == 'galactic':
+            c = fastquery.GalCoords(lon, lat)
+        else:
+            c = fastquery.GalCoords.from_icrs(lon, lat)
+        return hp.pixelfunc.ang2pix(args.nside, c.l, c.b,
+                                    lonlat=True, nest=True)
+
+    print('{: >9s}  {: >8s}  {: >12s}  {: >12s}  {: >8s}'.format(
+        'n', 'frame', 'SkyCoord (s)', 'fast (s)', 'speedup'))
+
+    for n in args.sizes:
+        lon, lat = random_coords(n)
+        for frame in ('galactic', 'icrs'):
+            t_sky = best_time(lambda: skycoord_pix(lon, lat, frame), args.repeat)
+            t_fast = best_time(lambda: fast_pix(lon, lat, frame), args.repeat)
+            print('{: >9d}  {: >8s}  {: >12.5f}  {: >12.5f}  {: >7.1f}x'.format(
+                n, frame, t_sky, t_fast, t_sky/t_fast))
+
+            if q is not None:
+                sky = lambda: q(SkyCoord(lon*units.deg, lat*units.deg,
+                                         frame=frame),
+                                mode='median')
+                if frame == 'galactic':
+                    fast = lambda: fastquery.bayestar_query(
+                        q, fastquery.GalCoords(lon, lat), mode='median')
+                else:
+                    fast = lambda: fastquery.bayestar_query(
+                        q, fastquery.GalCoords.from_icrs(lon, lat),
+                        mode='median')
+                t_sky = best_time(sky, args.repeat)
+                t_fast = best_time(fast, args.repeat)
+                print('{: >9s}  {: >8s}  {: >12.5f}  {: >12.5f}  {: >7.1f}x'.format(
+                    '(query)', frame, t_sky, t_fast, t_sky/t_fast))
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Benchmarks the per-request overhead of the rate limiter (see
+# map3d/rate_limit.py), comparing the token-bucket script (one round trip)
+# with the fixed-window counter it replaced (a pipeline of INCR and
+# EXPIREAT, plus a GET of the cost budget). Runs against a Redis server, or
+# (with --fake) against fakeredis, which also serves as a check that the
+# limiter works without a server.
+#
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+
+root_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, 'map3d'))
+
+
+def fixed_window(client, key_prefix, limit, per, cost_limit):
+    # The previous limiter: one counter per window
+    reset = (int(time.time()) // per) * per + per
+    key = key_prefix + str(reset)
+    p = client.pipeline()
+    p.incr(key)
+    p.expireat(key, reset + 10)
+    if cost_limit is not None:
+        p.get(key_prefix + 'cost/' + str(reset))
+    return p.execute()[0] <= limit
+
+
+def best_time(f, n, n_repeat):
+    t = []
+    for k in range(n_repeat):
+        t0 = time.time()
+        for j in range(n):
+            f(j)
+        t.append(time.time() - t0)
+    return min(t) / n
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Benchmark the per-request overhead of the rate limiter.",
+        add_help=True)
+    parser.add_argument("--host", metavar="HOST",
+                        type=str, default='localhost',
+                        help="Redis host.")
+    parser.add_argument("--port", metavar="PORT",
+                        type=int, default=6379,
+                        help="Redis port.")
+    parser.add_argument("--fake", action='store_true',
+                        help="Use fakeredis, rather than a Redis server.")
+    parser.add_argument("--requests", "-n", metavar="N",
+                        type=int, default=10000,
+                        help="Number of requests per repetition.")
+    parser.add_argument("--clients", "-c", metavar="N",
+                        type=int, default=100,
+                        help="Number of distinct clients (keys).")
+    parser.add_argument("--repeat", "-r", metavar="N",
+                        type=int, default=3,
+                        help="Number of repetitions (best time is reported).")
+    args = parser.parse_args()
+
+    if args.fake:
+        import fakeredis
+        client = fakeredis.FakeRedis()
+    else:
+        from redis import Redis
+        client = Redis(host=args.host, port=args.port)
+
+    from rate_limit import RateLimit
+
+    limit, per, cost_limit = 10**9, 300, 10**12
+    prefix = 'bench-rate-limit/{}/'
+
+    # Check that the token buckets limit the requests
+    rl = [RateLimit(prefix.format('check'), 3, per, False, client=client)
+          for k in range(4)]
+    assert [r.allowed for r in rl] == [True, True, True, False]
+    assert rl[0].charge(1) and (rl[2].remaining == 0)
+    rl = RateLimit(prefix.format('check-cost'), 3, per, False,
+                   cost_limit=100, client=client)
+    assert rl.charge(60) and not rl.charge(60) and (rl.cost_remaining == 40)
+    client.delete(*client.keys(prefix.format('check') + '*'))
+    client.delete(*client.keys(prefix.format('check-cost') + '*'))
+
+    def token_bucket(j):
+        key_prefix = prefix.format('tb-{}'.format(j % args.clients))
+        rl = RateLimit(key_prefix, limit, per, False,
+                       cost_limit=cost_limit, client=client)
+        rl.charge(100)
+
+    def token_bucket_no_cost(j):
+        key_prefix = prefix.format('tb-{}'.format(j % args.clients))
+        RateLimit(key_prefix, limit, per, False, client=client)
+
+    def window(j):
+        key_prefix = prefix.format('fw-{}'.format(j % args.clients))
+        fixed_window(client, key_prefix, limit, per, cost_limit)
+
+    print('{: >36s}  {: >12s}  {: >14s}'.format(
+        'limiter', 'round trips', 'per request'))
+    for name, f, n_rt in (
+            ('fixed window (pipeline)', window, 1),
+            ('token bucket (script)', token_bucket_no_cost, 1),
+            ('token bucket (script) + cost charge', token_bucket, 2)):
+        t = best_time(f, args.requests, args.repeat)
+        print('{: >36s}  {: >12d}  {: >11.1f} us'.format(name, n_rt, t*1.e6))
+
+    for key in client.keys(prefix.format('') + '*'):
+        client.delete(key)
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Benchmarks queries of a Bayestar map at random coordinates, comparing
+# queries in the original (random) order with queries sorted spatially by
+# nested HEALPix index (see map3d/parallel.py). With --mmap, the map is
+# stored in the disk cache and memory-mapped, as it is with
+# MAP3D_SHARE_MAPS=1. To measure the effect of page faults, drop the page
+# cache before running (e.g., "echo 1 > /proc/sys/vm/drop_caches").
+#
+
+from __future__ import print_function, division
+
+import os
+import sys
+import time
+
+import numpy as np
+
+root_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, 'map3d'))
+import fastquery
+import parallel
+
+
+def best_time(f, n_repeat):
+    t = []
+    for k in range(n_repeat):
+        t0 = time.time()
+        f()
+        t.append(time.time() - t0)
+    return min(t)
+
+
+def random_coords(n, seed=0):
+    rng = np.random.RandomState(seed)
+    lon = rng.uniform(0., 360., n)
+    lat = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+    dist = 10.**rng.uniform(-1., 1., n)
+    return fastquery.GalCoords(lon, lat, d=dist)
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Benchmark Bayestar queries of coordinates in random vs. "
+                    "spatially sorted order.",
+        add_help=True)
+    parser.add_argument("map_fname", metavar="BAYESTAR.h5",
+                        type=str, help="Bayestar map.")
+    parser.add_argument("--sizes", "-n", metavar="N",
+                        type=int, nargs='+',
+                        default=[100000, 300000, 1000000],
+                        help="Numbers of coordinates to benchmark.")
+    parser.add_argument("--modes", metavar="MODE",
+                        type=str, nargs='+',
+                        default=['best', 'samples', 'random_sample'],
+                        help="Query modes to benchmark.")
+    parser.add_argument("--max-samples", "-s", metavar="N",
+                        type=int, default=5,
+                        help="Number of samples per pixel to load.")
+    parser.add_argument("--mmap", action='store_true',
+                        help="Memory-map the map from the disk cache.")
+    parser.add_argument("--repeat", "-r", metavar="N",
+                        type=int, default=3,
+                        help="Number of repetitions (best time is reported).")
+    args = parser.parse_args()
+
+    from dustmaps.bayestar import BayestarQuery
+    load = lambda: BayestarQuery(map_fname=args.map_fname,
+                                 max_samples=args.max_samples)
+    if args.mmap:
+        import map_cache
+        source = map_cache.file_signature(args.map_fname)
+        q = map_cache.cached_object(
+            'bench-' + os.path.basename(args.map_fname),
+            map_cache.cache_key(source, args.max_samples),
+            load)
+    else:
+        q = load()
+
+    def query(coords, mode, sort):
+        kwargs = dict(mode=mode)
+        if sort:
+            order = fastquery.spatial_order(coords)
+            res = fastquery.bayestar_query(q, coords.take(order), **kwargs)
+            return parallel.unsort(res, order)
+        return fastquery.bayestar_query(q, coords, **kwargs)
+
+    print('{: >9s}  {: >14s}  {: >12s}  {: >12s}  {: >8s}'.format(
+        'n', 'mode', 'random (s)', 'sorted (s)', 'speedup'))
+
+    for n in args.sizes:
+        coords = random_coords(n)
+        for mode in args.modes:
+            t_random = best_time(lambda: query(coords, mode, False), args.repeat)
+            t_sorted = best_time(lambda: query(coords, mode, True), args.repeat)
+            print('{: >9d}  {: >14s}  {: >12.5f}  {: >12.5f}  {: >7.2f}x'.format(
+                n, mode, t_random, t_sorted, t_random/t_sorted))
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, division
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+
+def build_image(name):
+    from map3d import mapdata
+    print('Building image cache for {} ...'.format(name))
+    nside, img = mapdata.image_data[name]
+    print('  {}: nside = {}, shape = {}'.format(name, nside, img.shape))
+    return name
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Build the on-disk cache of the map images used to "
+                    "generate postage stamps.",
+        add_help=True)
+    parser.add_argument("--maps", "-m", metavar="MAP",
+                        type=str, nargs='+', default=None,
+                        help="Maps to build images for (default: all).")
+    parser.add_argument("--processes", "-p", metavar="N",
+                        type=int, default=1,
+                        help="Number of maps to process in parallel.")
+    args = parser.parse_args()
+
+    from map3d import mapdata
+
+    map_names = args.maps
+    if map_names is None:
+        map_names = mapdata.image_data.available()
+
+    if args.processes > 1:
+        # Each process writes its image to the cache, so that only the map
+        # names need to be passed back.
+        from multiprocessing import Pool
+        pool = Pool(args.processes)
+        pool.map(build_image, map_names)
+        pool.close()
+        pool.join()
+    else:
+        for name in map_names:
+            build_image(name)
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# Measures the CPU time and peak memory of queries of each map, in each query
+# mode, and fits the coefficients of the query cost model (see
+# map3d/cost_model.py): the cost per coordinate and per output element.
+# Queries are run with and without distances, at several sizes, using the
+# same code path as /api/v2 queries. The coefficients are written to the cost
+# model file (MAP3D_COST_MODEL), which the server reads when it starts.
+# Coefficients of maps that are not calibrated are kept.
+#
+# Peak memory is measured with tracemalloc (Python 3 only). Otherwise, the
+# default memory coefficients are used.
+#
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+
+import numpy as np
+from scipy.optimize import nnls
+
+root_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, 'map3d'))
+import mapdata
+import fastquery
+import parallel
+import cost_model
+from config import cost_model_fname
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+bayestar_modes = {
+    'random_sample': {},
+    'random_sample_per_pix': {},
+    'samples': {},
+    'median': {},
+    'mean': {},
+    'best': {},
+    'percentile': {'pct': [16., 50., 84.]}}
+
+
+def random_coords(n, dist=True, seed=0):
+    rng = np.random.RandomState(seed)
+    l = rng.uniform(0., 360., n)
+    b = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+    d = 10.**rng.uniform(-1., 1., n) if dist else None
+    return fastquery.GalCoords(l, b, d=d)
+
+
+def measure(handler, coords, kwargs, min_seconds):
+    """
+    Returns the mean CPU time and the peak memory (or ``None``, if it cannot
+    be measured) of a query. The query is repeated until it has used at
+    least ``min_seconds`` of CPU time, as the CPU time is only measured to
+    the nearest clock tick.
+    """
+    query = lambda: parallel.query_gal(handler, coords, **kwargs)
+
+    n = 0
+    t0 = cost_model.cpu_time()
+    while (n == 0) or (cost_model.cpu_time() - t0 < min_seconds):
+        query()
+        n += 1
+    t = (cost_model.cpu_time() - t0) / n
+
+    n_bytes = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        query()
+        n_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return t, n_bytes
+
+
+def fit(x, y):
+    # Non-negative least squares fit of y = x . coeffs, weighting each
+    # measurement by the inverse of its value, so that the relative errors
+    # are minimized
+    x = np.array(x, dtype='f8')
+    y = np.array(y, dtype='f8')
+    w = 1. / np.maximum(y, 1.e-9)
+    coeffs, _ = nnls(x * w[:,None], y * w)
+    return [float(c) for c in coeffs]
+
+
+def calibrate(name, handler, sizes, min_seconds):
+    if 'mode' in handler.get('schema', {}):
+        modes = bayestar_modes
+    else:
+        modes = {'default': {}}
+
+    res = {}
+    for mode, kwargs in modes.items():
+        if mode != 'default':
+            kwargs = dict(kwargs, mode=mode)
+        x, t, n_bytes = [], [], []
+        for n in sizes:
+            for dist in (True, False):
+                coords = random_coords(n, dist=dist)
+                n_elements = handler['query_size'](coords, **kwargs)
+                t_k, n_bytes_k = measure(handler, coords, kwargs, min_seconds)
+                x.append([n, n_elements])
+                t.append(t_k)
+                n_bytes.append(n_bytes_k)
+                print('{: >10s}  {: >22s}  {: >9d}  {: >11d}  {: >9.4f}  {: >11s}'.format(
+                    name, mode, n, int(n_elements), t_k,
+                    '-' if n_bytes_k is None else '{:.0f}'.format(n_bytes_k)))
+
+        seconds = fit(x, t)
+        if None in n_bytes:
+            n_bytes = list(cost_model.coefficients(name, mode)[1])
+        else:
+            n_bytes = fit(x, n_bytes)
+        res[mode] = {'seconds': seconds, 'bytes': n_bytes}
+
+    return res
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Calibrate the query cost model on this host.",
+        add_help=True)
+    parser.add_argument("--maps", "-m", metavar="MAP",
+                        type=str, nargs='+', default=None,
+                        help="Maps to calibrate (default: all).")
+    parser.add_argument("--sizes", "-n", metavar="N",
+                        type=int, nargs='+', default=[1000, 10000],
+                        help="Numbers of coordinates to query.")
+    parser.add_argument("--min-seconds", "-t", metavar="SECONDS",
+                        type=float, default=0.5,
+                        help="Minimum CPU time over which to average the "
+                             "time of each query.")
+    parser.add_argument("--output", "-o", metavar="COST_MODEL.json",
+                        type=str, default=cost_model_fname,
+                        help="Cost model file.")
+    args = parser.parse_args()
+
+    names = args.maps
+    if names is None:
+        names = sorted(
+            name for name,h in mapdata.handlers.items() if 'query_gal' in h)
+
+    calibration = {}
+    if os.path.exists(args.output):
+        with open(args.output, 'r') as f:
+            calibration = json.load(f)
+
+    print('{: >10s}  {: >22s}  {: >9s}  {: >11s}  {: >9s}  {: >11s}'.format(
+        'map', 'mode', 'n_coords', 'n_elements', 't (s)', 'peak (B)'))
+
+    for name in names:
+        handler = mapdata.handlers[name]
+        handler['q']
+        calibration[name] = calibrate(name, handler, args.sizes, args.min_seconds)
+
+    print('Writing {} ...'.format(args.output))
+    with open(args.output, 'w') as f:
+        json.dump(calibration, f, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
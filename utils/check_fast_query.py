@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+# Checks that the fast query path (map3d/fastquery.py and map3d/pixquery.py)
+# returns the same results as dustmaps. The fast path reimplements
+# BayestarQuery.query on top of private attributes of the dustmaps query
+# objects, so this should be run after upgrading dustmaps (and the version
+# in requirements.txt only updated if it passes).
+#
+# Compares, at random coordinates (spread over the sky, and clustered in a
+# few pixels, so that the deduplicated path is also used), with and without
+# distances and flags, in each query mode:
+#
+#   - fastquery.bayestar_query (with and without shared pixel indices) and
+#     fastquery.bayestar_query_samples_best with BayestarQuery.query,
+#   - the ICRS -> Galactic conversion of GalCoords.from_icrs with astropy.
+#
+# Results must be identical (including dtypes and shapes). In the unseeded
+# random modes, the global NumPy random state is reset before each query,
+# so that both paths draw the same samples. Returns a nonzero exit code if
+# any check fails.
+#
+
+from __future__ import print_function, division
+
+import os
+import sys
+
+import numpy as np
+
+import astropy.units as units
+from astropy.coordinates import SkyCoord
+
+root_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, os.path.join(root_dir, 'map3d'))
+import fastquery
+
+
+modes = [
+    ('random_sample', {}),
+    ('random_sample_per_pix', {}),
+    ('samples', {}),
+    ('median', {}),
+    ('mean', {}),
+    ('best', {}),
+    ('percentile', {'pct': 50.}),
+    ('percentile', {'pct': [16., 50., 84.]})]
+
+# Largest allowed difference (in degrees) between the fast ICRS -> Galactic
+# conversion and astropy's
+max_conversion_error = 1.e-9
+
+
+def random_coords(rng, n, clustered=False):
+    if clustered:
+        # A few small patches, so that many coordinates share a pixel
+        l0 = rng.uniform(0., 360., 5)
+        b0 = np.degrees(np.arcsin(rng.uniform(-1., 1., 5)))
+        k = rng.randint(0, 5, n)
+        l = (l0[k] + rng.normal(0., 0.01, n)) % 360.
+        b = np.clip(b0[k] + rng.normal(0., 0.01, n), -90., 90.)
+    else:
+        l = rng.uniform(0., 360., n)
+        b = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+    # Distances below the nearest and beyond the farthest distance bins
+    d = 10.**rng.uniform(-2., 1.5, n)
+    return l, b, d
+
+
+def equal(a, b):
+    # Compares query outputs: arrays (possibly structured), or tuples of them
+    if isinstance(a, tuple) or isinstance(b, tuple):
+        return (type(a) == type(b)) and (len(a) == len(b)) and \
+               all(equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, list) or isinstance(b, list):
+        return (type(a) == type(b)) and (len(a) == len(b)) and \
+               all(equal(x, y) for x, y in zip(a, b))
+    a = np.asarray(a)
+    b = np.asarray(b)
+    if (a.shape != b.shape) or (a.dtype != b.dtype):
+        return False
+    if a.dtype.names is not None:
+        return all(equal(a[k], b[k]) for k in a.dtype.names)
+    if a.dtype.kind == 'f':
+        return np.array_equal(np.isnan(a), np.isnan(b)) and \
+               np.array_equal(a[~np.isnan(a)], b[~np.isnan(b)])
+    return np.array_equal(a, b)
+
+
+def check_queries(q, l, b, d, shape, label):
+    n_failed = 0
+
+    coords = fastquery.GalCoords(l.reshape(shape), b.reshape(shape),
+                                 d=None if d is None else d.reshape(shape))
+    sc = coords.to_skycoord()
+
+    for mode, kwargs in modes:
+        for return_flags in (False, True):
+            kw = dict(kwargs, mode=mode, return_flags=return_flags)
+
+            np.random.seed(1)
+            ref = q(sc, **kw)
+            np.random.seed(1)
+            out = fastquery.bayestar_query(q, coords, **kw)
+            np.random.seed(1)
+            out_cached = fastquery.bayestar_query(q, coords, ipix_cache={}, **kw)
+
+            ok = equal(ref, out) and equal(ref, out_cached)
+            n_failed += not ok
+            print('{: <34s}  {: <22s}  {: >5s}  {: <12s}  {}'.format(
+                label, mode, str(return_flags),
+                'list pct' if isinstance(kwargs.get('pct'), list) else '',
+                'OK' if ok else 'MISMATCH'))
+
+    samples, flags = q(sc, mode='samples', return_flags=True)
+    best = q(sc, mode='best')
+    out = fastquery.bayestar_query_samples_best(q, coords)
+    ok = equal(list(out), [samples, best, flags])
+    n_failed += not ok
+    print('{: <34s}  {: <22s}  {: >5s}  {: <12s}  {}'.format(
+        label, 'samples + best', 'True', '', 'OK' if ok else 'MISMATCH'))
+
+    return n_failed
+
+
+def check_conversion(rng, n):
+    ra = rng.uniform(0., 360., n)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+    fast = fastquery.GalCoords.from_icrs(ra, dec)
+    ref = SkyCoord(ra*units.deg, dec*units.deg, frame='icrs').galactic
+    sep = SkyCoord(fast.l*units.deg, fast.b*units.deg, frame='galactic')
+    err = np.max(sep.separation(ref).deg)
+    ok = (err <= max_conversion_error)
+    print('ICRS -> Galactic: max. error {:.3g} deg  {}'.format(
+        err, 'OK' if ok else 'MISMATCH'))
+    return int(not ok)
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Check the fast query path against dustmaps.",
+        add_help=True)
+    parser.add_argument("--map-fname", metavar="BAYESTAR.h5",
+                        type=str, default=None,
+                        help="Bayestar map file (default: the dustmaps "
+                             "copy of the given version).")
+    parser.add_argument("--version", metavar="VERSION",
+                        type=str, default='bayestar2019',
+                        help="Bayestar version, if no file is given.")
+    parser.add_argument("--max-samples", metavar="N",
+                        type=int, default=None,
+                        help="Number of samples to load.")
+    parser.add_argument("--n-coords", "-n", metavar="N",
+                        type=int, default=5000,
+                        help="Number of coordinates per check.")
+    parser.add_argument("--seed", metavar="SEED",
+                        type=int, default=0,
+                        help="Seed of the random coordinates.")
+    args = parser.parse_args()
+
+    import dustmaps
+    from dustmaps.bayestar import BayestarQuery
+    print('dustmaps {}'.format(getattr(dustmaps, '__version__', '(unknown)')))
+
+    kw = {'max_samples': args.max_samples}
+    if args.map_fname is None:
+        kw['version'] = args.version
+    else:
+        kw['map_fname'] = args.map_fname
+    q = BayestarQuery(**kw)
+
+    rng = np.random.RandomState(args.seed)
+    n = args.n_coords
+    n_failed = 0
+
+    for clustered in (False, True):
+        l, b, d = random_coords(rng, n, clustered=clustered)
+        label = 'clustered' if clustered else 'all-sky'
+        for dist in (False, True):
+            d_k = d if dist else None
+            label_k = label + (', distances' if dist else '')
+            n_failed += check_queries(q, l, b, d_k, (n,), label_k)
+        # Multidimensional and scalar coordinates
+        n_failed += check_queries(q, l[:n//10*10], b[:n//10*10], None,
+                                  (n//10, 10), label + ', 2D')
+        n_failed += check_queries(q, l[:1], b[:1], d[:1], (),
+                                  label + ', scalar, distance')
+
+    n_failed += check_conversion(rng, n)
+
+    if n_failed:
+        print('{} checks FAILED.'.format(n_failed))
+        return 1
+    print('All checks passed.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# Precomputes summary statistics (mean, median and percentiles) of the
+# samples in each pixel of a Bayestar map, so that the server can answer
+# 'mean', 'median' and 'percentile' queries by looking up the precomputed
+# values, rather than reducing the samples on every request. The output file
+# should be placed next to the map, as <map name>-summary.h5.
+#
+# The statistics are computed over the same samples that the server uses
+# (the first --max-samples samples in each pixel), in the same way, so that
+# the results are the same as those computed on the fly.
+#
+
+from __future__ import print_function, division
+
+import os
+import sys
+
+import numpy as np
+import h5py
+
+from contextlib import closing
+from progressbar import ProgressBar
+
+from dustmaps.bayestar import BayestarQuery
+
+root_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, 'map3d'))
+from map_cache import file_signature
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description="Precompute per-pixel summary statistics of a Bayestar "
+                    "map's samples.",
+        add_help=True)
+    parser.add_argument("in_fname", metavar="INPUT.h5",
+                        type=str, help="Input map filename.")
+    parser.add_argument("out_fname", metavar="OUTPUT.h5",
+                        type=str, help="Output filename.")
+    parser.add_argument("--max-samples", "-s", metavar="N",
+                        type=int, default=5,
+                        help="Number of samples per pixel used by the server.")
+    parser.add_argument("--pct", "-p", metavar="PERCENTILE",
+                        type=float, nargs='+',
+                        default=[15.8, 16., 50., 84., 84.2],
+                        help="Percentiles to precompute.")
+    parser.add_argument("--chunk-size", metavar="N",
+                        type=int, default=10000,
+                        help="Number of pixels to process at a time.")
+    args = parser.parse_args()
+
+    q = BayestarQuery(map_fname=args.in_fname, max_samples=args.max_samples)
+    samples = q._samples
+    n_pix, n_samples, n_dists = samples.shape
+    pct = np.array(args.pct, dtype='f8')
+
+    print("Computing summary statistics ...")
+
+    mean = np.empty((n_pix, 1, n_dists), dtype='f4')
+    median = np.empty((n_pix, 1, n_dists), dtype='f4')
+    pctiles = np.empty((n_pix, len(pct), n_dists), dtype='f4')
+
+    # Reduce the samples in the same way as BayestarQuery.query, with the
+    # samples along axis 1
+    bar = ProgressBar(max_value=n_pix, redirect_stdout=False)
+    for k0 in range(0, n_pix, args.chunk_size):
+        s = slice(k0, k0+args.chunk_size)
+        x = samples[s]
+        mean[s,0] = np.mean(x, axis=1)
+        median[s,0] = np.median(x, axis=1)
+        pctiles[s] = np.moveaxis(np.nanpercentile(x, pct, axis=1), 0, 1)
+        bar.update(min(k0+args.chunk_size, n_pix))
+    bar.finish()
+
+    source = file_signature(args.in_fname)
+
+    print("Writing {} ...".format(args.out_fname))
+    with closing(h5py.File(args.out_fname, 'w')) as f:
+        f.create_dataset('mean', data=mean)
+        f.create_dataset('median', data=median)
+        f.create_dataset('percentile', data=pctiles)
+        f.attrs['pct'] = pct
+        f.attrs['max_samples'] = args.max_samples
+        f.attrs['source_size'] = source['size']
+        f.attrs['source_sha1'] = source['sha1']
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()